@@ -0,0 +1,172 @@
+"""
+Consolidate the per-minute encoder files into one file per day, recalibrated with the
+current constants in converter.py.
+
+	python batchConvert.py [data directory] [output directory] [processes]
+
+Walks the MM-DD-YYYY directories under the data directory (default: the working
+directory) and writes <output directory>/MM-DD-YYYY.h5 for each. The minute files
+are read and recalibrated in parallel across a process pool, the parent stitches
+each day together in time order.
+
+The raw encoder codes are recovered from the stored angles by inverting the
+calibration the file was written with (the constants stored on its data dataset,
+or the ones currently in converter.py for files older than that), then converted
+again with the current tables. The counter is unwrapped again over the whole day.
+
+Each day file has:
+	data  - t, el, az, rev, counter, same as the minute files
+	index - tStart, tStop, start, stop: the time range and row range of each minute file
+	files - the name of the minute file each index row came from
+Files from before sample timestamps were recorded get t = NaN, and their index row
+spans the minute in their file name.
+
+Rows that are already in the day file are dropped:
+	- files with timestamps: rows at or before a row already written (in this file or the
+	  previous ones, after the acquisition was restarted)
+	- older files: the old collector never cleared its array, it wrote all of it out and
+	  rewound to the start for each new minute. So behind a file's own rows (and the
+	  zero padding) are the rows left over from earlier minutes, in the same places as
+	  in the previous file. Rows identical to the previous file's row at the same
+	  position (el, az and the counter, which counts a clock so it never repeats within
+	  a run) are those, and are dropped.
+"""
+import os
+import re
+import sys
+import time
+import datetime as dt
+import multiprocessing
+import numpy as np
+import h5py
+import decoder
+import converter
+
+dateDir = re.compile(r"^\d\d-\d\d-\d\d\d\d$")
+minuteFile = re.compile(r"^\d\d-\d\d\.h5$")
+
+dayDtype = converter.fileWriter(converter.sampleDtype).dtype
+
+_cal = None
+
+def _init(constants):
+	global _cal
+	_cal = converter.calibration(**constants)
+
+def rawCodes(data, constants):
+	# invert the calibration given by constants, returns el codes and az codes
+	elCode = np.rint((data["el"]-constants["eloffset"])/constants["elgain"]).astype(np.int64)
+	azCode = np.rint((data["az"]-constants["azoffset"])/constants["azgain"]).astype(np.int64)%decoder.AZ_CODES
+	return elCode, azCode
+
+def readData(path):
+	# the data dataset of a minute file and its attributes
+	with h5py.File(path, "r") as h5file:
+		dataset = h5file["data"]
+		return dataset[...].reshape(-1), dict(dataset.attrs)		# the oldest files were stored as an (n, 1) array
+
+def staleRows(data, prevPath):
+	# mask of the rows of an old (untimestamped) file left over from earlier minutes, see the module doc
+	if prevPath is None:
+		return np.zeros(len(data), dtype=bool)
+	prev = readData(prevPath)[0]
+	if "t" in prev.dtype.names:		# the first file after the switch to timestamps, nothing shared
+		return np.zeros(len(data), dtype=bool)
+	n = min(len(data), len(prev))
+	stale = np.zeros(len(data), dtype=bool)
+	stale[:n] = (data["el"][:n]==prev["el"][:n]) & (data["az"][:n]==prev["az"][:n]) & (data["rev"][:n]==prev["rev"][:n])
+	return stale
+
+def convertFile(paths):
+	# read and recalibrate one minute file (runs in the worker processes)
+	# paths - (the file, the file before it or None)
+	# returns the rows and the (tStart, tStop) they span
+	path, prevPath = paths
+	data, attrs = readData(path)
+	constants = converter.calibration().attrs()
+	constants.update((k, float(v)) for k, v in attrs.items() if k in constants)
+	rows = np.zeros(len(data), dtype=dayDtype)
+	if "t" in data.dtype.names:
+		rows["t"] = data["t"]
+	else:
+		# the oldest files were written out with the whole collector array: the unused tail
+		# all zeros, and before that the rows from earlier minutes
+		data = data[((data["el"]!=0) | (data["az"]!=0) | (data["rev"]!=0)) & ~staleRows(data, prevPath)]
+		rows = rows[:len(data)]
+		rows["t"] = np.nan
+	elCode, azCode = rawCodes(data, constants)
+	rows["el"] = _cal.elTable[np.clip(elCode, 0, len(_cal.elTable)-1)]
+	rows["az"] = _cal.azTable[azCode]
+	rows["rev"] = data["rev"]
+	if len(rows) and not np.isnan(rows["t"][0]):
+		span = (rows["t"][0], rows["t"][-1])
+	else:
+		day, minute = path.split(os.sep)[-2:]
+		start = dt.datetime.strptime(day+" "+minute, "%m-%d-%Y %H-%M.h5")
+		span = (time.mktime(start.timetuple()), time.mktime(start.timetuple())+60.)
+	return rows, span
+
+def writeDay(path, names, results, constants):
+	rows = np.concatenate([r for r, span in results]) if results else np.zeros(0, dtype=dayDtype)
+	rows["counter"] = converter.unwrapCounter(rows["rev"])[0]
+	stops = np.cumsum([len(r) for r, span in results])
+	index = np.zeros(len(results), dtype=converter.fileWriter.indexDtype)
+	index["tStart"] = [span[0] for r, span in results]
+	index["tStop"] = [span[1] for r, span in results]
+	index["stop"] = stops
+	index["start"] = stops-[len(r) for r, span in results]
+	with h5py.File(path, "w") as h5file:
+		h5file.create_dataset("data", data=rows, chunks=True, compression="gzip", shuffle=True)
+		h5file["data"].attrs.update(constants)
+		h5file.create_dataset("index", data=index)
+		h5file.create_dataset("files", data=np.array(names, dtype="S"))
+
+def findFiles(root):
+	# {day: [minute file paths, in time order]}
+	days = {}
+	for day in sorted(os.listdir(root)):
+		if dateDir.match(day) and os.path.isdir(os.path.join(root, day)):
+			files = sorted(f for f in os.listdir(os.path.join(root, day)) if minuteFile.match(f))
+			if files:
+				days[day] = [os.path.join(root, day, f) for f in files]
+	return days
+
+def convertAll(root, out, processes=None):
+	constants = converter.calibration().attrs()
+	days = findFiles(root)
+	order = sorted(days, key=lambda d: dt.datetime.strptime(d, "%m-%d-%Y"))
+	pool = multiprocessing.Pool(processes, _init, (constants,))
+	try:
+		# All the files go out to the pool at once, the results come back in order, so the
+		# workers keep going on the next days while the parent writes out each finished day.
+		# chunksize 1: the files are big enough that per-file dispatch is cheap
+		files = [f for day in order for f in days[day]]
+		results = pool.imap(convertFile, zip(files, [None]+files[:-1]), 1)
+		end = -np.inf		# time of the last row written
+		for day in order:
+			dayResults = []
+			for f in days[day]:
+				rows, span = results.next()
+				if len(rows) and not np.isnan(rows["t"][0]):
+					# rows at or before one already written (acquisition restarted, into this file or the last)
+					rows = rows[rows["t"]>np.maximum.accumulate(np.concatenate(([end], rows["t"][:-1])))]
+					if len(rows):
+						end = rows["t"][-1]
+						span = (rows["t"][0], end)
+				dayResults.append((rows, span))
+			writeDay(os.path.join(out, day+".h5"), [os.path.basename(f) for f in days[day]], dayResults, constants)
+			print day, len(days[day]), "files", sum(len(r) for r, span in dayResults), "samples"
+	finally:
+		pool.close()
+		pool.join()
+
+if __name__=='__main__':
+	if len(sys.argv)>1 and sys.argv[1] in ("-h", "--help"):
+		print __doc__
+		sys.exit()
+	root = sys.argv[1] if len(sys.argv)>1 else "."
+	out = sys.argv[2] if len(sys.argv)>2 else root
+	processes = int(sys.argv[3]) if len(sys.argv)>3 else None
+	if not os.path.exists(out):
+		os.makedirs(out)
+	convertAll(root, out, processes)
@@ -0,0 +1,119 @@
+"""
+Throughput benchmark for the encoder reader, runs on the simulated DAQ.
+
+	python benchmark.py [seconds per run] [samples per read]
+
+Each run pushes unpaced simulated blocks through more of the acquisition pipeline:
+	decode    - decoder.decode only
+	buffer    - decode, calibrate and add to the ring buffer
+	hdf5      - all of the above, plus the flush thread writing HDF5 files
+	single    - the software timed loop, one sample per read, end to end
+and prints the achieved samples per second. Simulated frames are generated up front
+so the simulator's own cost is not counted. Files are written to a temporary
+directory which is removed afterwards.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import numpy as np
+import decoder
+import fakeDAQ
+import converter
+
+def blocks(sampsPerRead, nBlocks=16):
+	eye = fakeDAQ.BufferedEyeball(rate=None, sampsPerRead=sampsPerRead, noise=0.01, seed=0)
+	return [eye.getBlock() for i in range(nBlocks)]
+
+cal = converter.calibration()
+
+def calibrate(elCode, azCode):
+	return cal.elTable[elCode], cal.azTable[azCode]
+
+def ramp(n, rate=1e6):
+	# sample time offsets within a block
+	return np.arange(n)/rate
+
+def run(seconds, step):
+	# call step() until seconds have passed, returns the samples per second it reports
+	n = 0
+	t0 = time.time()
+	while time.time()-t0<seconds:
+		n += step()
+	return n/(time.time()-t0)
+
+def benchDecode(seconds, frames):
+	state = {"i": 0}
+	def step():
+		state["i"] += 1
+		decoder.decode(frames[state["i"]%len(frames)])
+		return len(frames[0])
+	return run(seconds, step)
+
+def benchBuffer(seconds, frames):
+	data = converter.datacollector()
+	state = {"i": 0}
+	def step():
+		state["i"] += 1
+		elCode, azCode, rev = decoder.decode(frames[state["i"]%len(frames)])
+		el, az = calibrate(elCode, azCode)
+		data.addBlock(el, az, rev, converter.timestamp()+ramp(len(rev)))
+		data.markFlushed()
+		return len(rev)
+	return run(seconds, step)
+
+def benchHDF5(seconds, frames, flushEvery=0.05):
+	data = converter.datacollector()
+	flusher = converter.flushThread(data, converter.fileWriter(data.data.dtype))
+	flusher.start()
+	state = {"i": 0, "flushed": time.time()}
+	def step():
+		state["i"] += 1
+		elCode, azCode, rev = decoder.decode(frames[state["i"]%len(frames)])
+		el, az = calibrate(elCode, azCode)
+		n = data.addBlock(el, az, rev, converter.timestamp()+ramp(len(rev)))
+		if time.time()-state["flushed"]>=flushEvery:
+			flusher.handOff()
+			state["flushed"] = time.time()
+		return n
+	rate = run(seconds, step)
+	flusher.stop()
+	return rate, data.dropped
+
+def benchSingle(seconds, frames, flushEvery=0.05):
+	frames = [f for block in frames for f in block]
+	data = converter.datacollector()
+	flusher = converter.flushThread(data, converter.fileWriter(data.data.dtype))
+	flusher.start()
+	state = {"i": 0, "flushed": time.time()}
+	def step():
+		state["i"] += 1
+		elCode, azCode, rev = decoder.decode(frames[state["i"]%len(frames)])
+		el, az = calibrate(elCode, azCode)
+		data.add(el, az, rev, converter.timestamp())
+		if time.time()-state["flushed"]>=flushEvery:
+			flusher.handOff()
+			state["flushed"] = time.time()
+		return 1
+	rate = run(seconds, step)
+	flusher.stop()
+	return rate, data.dropped
+
+if __name__=='__main__':
+	seconds = float(sys.argv[1]) if len(sys.argv)>1 else 5.
+	sampsPerRead = int(sys.argv[2]) if len(sys.argv)>2 else 1000
+	frames = blocks(sampsPerRead)
+
+	cwd = os.getcwd()
+	tmp = tempfile.mkdtemp(prefix="encoderBench")
+	os.chdir(tmp)		# converter.fileWriter writes into date directories under the working directory
+	try:
+		print "samples per read: %d, %.1f s per run" % (sampsPerRead, seconds)
+		print "decode: %12.0f samples/s" % benchDecode(seconds, frames)
+		print "buffer: %12.0f samples/s" % benchBuffer(seconds, frames)
+		print "hdf5:   %12.0f samples/s, %d dropped" % benchHDF5(seconds, frames)
+		print "single: %12.0f samples/s, %d dropped" % benchSingle(seconds, frames)
+	finally:
+		os.chdir(cwd)
+		shutil.rmtree(tmp)
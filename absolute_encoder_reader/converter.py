@@ -2,9 +2,17 @@ import os
 import datetime as dt
 import numpy as np
 import h5py
-import getData
+try:
+	import getData
+except ImportError:		# no PyDAQmx on this machine, run off the simulator
+	import fakeDAQ as getData
+	print "PyDAQmx not found, using simulated DAQ"
+import decoder
 import time
 import sys
+import threading
+import Queue
+import json
 
 '''
 conversions for angles, integer to degrees:
@@ -13,7 +21,39 @@ conversions for angles, integer to degrees:
 azgain=-360./(2.**16)    #az encoder is 16 bits natural binary 
 elgain=-360./(40000.)    #stupid encoder is BCD 18 bits 4 digits of 4 bits and one of two bits max 4x10x10x10x10
 eloffset=295.026            #updated based on moon crossing 2013/08/02, cofe 10 ghz ch37
-azoffset=4.41496+140.	
+azoffset=4.41496+140.
+class calibration(object):
+	"""
+	Lookup tables from raw encoder codes to calibrated degrees.
+
+	Both encoders have small domains, so instead of doing the offset, gain and mod
+	arithmetic per sample, every possible code is converted once and calibrating
+	a sample (or a whole array of codes) is a table lookup: elTable[elCode],
+	azTable[azCode]. The tables are rebuilt by set() only when a constant changes.
+	"""
+	def __init__(self, eloffset=eloffset, elgain=elgain, azoffset=azoffset, azgain=azgain):
+		self.eloffset, self.elgain, self.azoffset, self.azgain = eloffset, elgain, azoffset, azgain
+		self.build()
+
+	def build(self):
+		# the el table also covers codes with invalid BCD digits (> 9), they convert the same linear way
+		self.elTable = self.eloffset+self.elgain*np.arange(decoder.WEIGHTS[:, 0].sum()+1)
+		self.azTable = np.mod(self.azoffset+self.azgain*np.arange(decoder.AZ_CODES), 360.)
+
+	def set(self, **constants):
+		# e.g. set(eloffset=295.1), rebuilds the tables if anything changed
+		changed = False
+		for name, value in constants.items():
+			if name not in ("eloffset", "elgain", "azoffset", "azgain"):
+				raise ValueError, "Unknown calibration constant %s" % name
+			changed = changed or getattr(self, name)!=value
+			setattr(self, name, value)
+		if changed:
+			self.build()
+
+	def attrs(self):
+		return {"eloffset": self.eloffset, "elgain": self.elgain, "azoffset": self.azoffset, "azgain": self.azgain}
+
 def bcd_to_int(bcd_str):
 	string= ''
 	return int(string.join([str(int(bcd_str[0:2],2)), str(int(bcd_str[2:6],2)), str(int(bcd_str[6:10],2)), str(int(bcd_str[10:14],2)), str(int(bcd_str[14:18],2))]))
@@ -21,50 +61,334 @@ def bcd_to_int(bcd_str):
 def bin_to_int(bin_str):
 	return int(bin_str,2)
 
-def fileStruct(n_array, data):
-	
-	t=dt.datetime.now()
+# Sample timestamps are seconds since the epoch. Where python has a monotonic clock it is used,
+# anchored to the wall clock at start-up, so timestamps never step backwards when the system
+# clock is adjusted. (python 2 has none, so there this is just time.time)
+_clock = getattr(time, "monotonic", time.time)
+_clockOffset = time.time()-_clock()
+
+def timestamp():
+	return _clockOffset+_clock()
+
+# For timing the loop (durations only, not timestamps): the highest resolution clock there is.
+# time.time on windows only ticks every 15 ms or so, time.clock there is the performance counter
+if hasattr(time, "perf_counter"):
+	timer = time.perf_counter
+elif sys.platform == "win32":
+	timer = time.clock
+else:
+	timer = time.time
+
+def unwrapCounter(rev, last=None, wraps=0):
+	# Unwrap a run of raw 24 bit counter readings into a continuous 64 bit count.
+	# last and wraps carry the state over from the previous run of readings (the last raw
+	# reading and the rollovers counted so far). A step back by more than half the counter
+	# range is a rollover, smaller steps back are left alone as glitches.
+	# returns the unwrapped counts, and the new (last, wraps)
+	rev = np.asarray(rev, dtype=np.int64)
+	if not len(rev):
+		return rev, last, wraps
+	prev = np.empty_like(rev)
+	prev[0] = rev[0] if last is None else last
+	prev[1:] = rev[:-1]
+	rollovers = wraps+np.cumsum(rev-prev < -decoder.COUNTER_CODES//2)
+	return rev+rollovers*decoder.COUNTER_CODES, int(rev[-1]), int(rollovers[-1])
+
+def filePath(t):
+	# MM-DD-YYYY/HH-MM.h5 for the given datetime
 	date = t.strftime("%m-%d-%Y")
-	time = t.strftime("%H-%M")
-	if not os.path.exists(date):#this is the first file being created for that time
+	if not os.path.exists(date):#this is the first file being created for that day
 		os.makedirs(date)
-		#set index to 0
-		
-	
-	path = '/'.join((date,time))
-	path = '.'.join((path,"h5"))
-	#print(path)
-	#fn = os.path.join(os.path.dirname(__file__), 'my_file')
-	#Sprint(fn)
-	if not os.path.exists(path):#every time we create a new file we wanna make sure it starts writting from the begining
-		print data.index
-		data.resetIndex()
-	
-	with h5py.File(str(path), 'w') as h5file:
-		h5file.create_dataset("data", data=n_array)
-		#set = h5file.create_dataset("data", (100, 100), 'i')
-	
-	
+	return '.'.join(('/'.join((date,t.strftime("%H-%M"))),"h5"))
+
+class fileWriter(object):
+	"""
+	Append-only writer for the per-minute encoder files.
+
+	The current file stays open with a resizable, chunked "data" dataset and each
+	append only writes the rows it is given, so a flush costs time proportional to
+	the new data. The file is flushed to disk after every append so a crash loses at
+	most the rows since the last flush. Files rotate every rotate seconds of sample
+	time, so rows always land in the file for the minute they were taken, also when
+	converting old data offline.
+
+	On the way out the 24 bit counter is unwrapped into the 64 bit "counter" column,
+	continuously across files. A writer that starts on a file that already has rows
+	(acquisition restarted within the minute) carries on from its last counter
+	value. Each append also adds a row to the small "index" dataset: the time range
+	and row range it wrote, so readers can find the rows for a time without
+	scanning the data.
+	"""
+	indexDtype = [("tStart", np.float64), ("tStop", np.float64), ("start", np.int64), ("stop", np.int64)]
+
+	def __init__(self, dtype, rotate=60, chunk=4096, attrs=None):
+		self.dtype = np.dtype(np.dtype(dtype).descr+[("counter", np.int64)])
+		self.counterLast, self.counterWraps = None, 0
+		self.attrs = attrs or {}		# stored on each data dataset, e.g. the calibration constants
+		self.rotate = rotate
+		self.chunk = chunk
+		self.h5file = None
+		self.period = None
+
+	def open(self, period):
+		self.close()
+		path = filePath(dt.datetime.fromtimestamp(period*self.rotate))
+		self.h5file = h5py.File(str(path), 'a')	#reopening a file after a restart appends to it
+		if "data" not in self.h5file:
+			self.h5file.create_dataset("data", (0,), dtype=self.dtype, maxshape=(None,), chunks=(self.chunk,))
+		if "index" not in self.h5file:
+			self.h5file.create_dataset("index", (0,), dtype=self.indexDtype, maxshape=(None,), chunks=(256,))
+		self.dataset = self.h5file["data"]
+		self.index = self.h5file["index"]
+		self.dataset.attrs.update(self.attrs)
+		self.period = period
+		if self.counterLast is None and len(self.dataset) and "counter" in self.dataset.dtype.names:
+			last = self.dataset[-1]
+			self.counterLast = int(last["rev"])
+			self.counterWraps = int((last["counter"]-last["rev"])//decoder.COUNTER_CODES)
+
+	def append(self, rows):
+		if not len(rows):
+			return
+		periods = (rows["t"]//self.rotate).astype(np.int64)
+		bounds = [0]+list(np.flatnonzero(np.diff(periods))+1)+[len(rows)]
+		for start, stop in zip(bounds[:-1], bounds[1:]):
+			if periods[start] != self.period:
+				self.open(int(periods[start]))
+			self.write(rows[start:stop])
+
+	def write(self, rows):
+		out = np.empty(len(rows), dtype=self.dtype)
+		for name in rows.dtype.names:
+			out[name] = rows[name]
+		out["counter"], self.counterLast, self.counterWraps = unwrapCounter(rows["rev"], self.counterLast, self.counterWraps)
+		n = self.dataset.shape[0]
+		self.dataset.resize((n+len(out),))
+		self.dataset[n:] = out
+		i = self.index.shape[0]
+		self.index.resize((i+1,))
+		self.index[i] = (out["t"][0], out["t"][-1], n, n+len(out))
+		self.h5file.flush()
+
+	def close(self):
+		if self.h5file is not None:
+			self.h5file.close()
+			self.h5file = None
+			self.period = None
+
+sampleDtype = [("t", np.float64), ("el", np.float), ("az", np.float), ("rev", np.int)]
 
 class datacollector(object):
-	def __init__(self):
-		self.index = 0
-		self.free_space = 0
-		self.data = np.zeros(self.free_space, dtype=[("el", np.float), ("az", np.float), ("rev", np.int)])
-	def resetIndex(self):
-		self.index=0
-	def add(self,az,el,rev):
-		if self.index>=self.free_space:
-				self.data.resize(self.index+1000, 1)
-				self.free_space = self.free_space+1000
-		self.data[self.index] = ((az,el,rev))
-		
-		self.index =self.index+ 1
+	"""
+	Fixed capacity ring buffer of samples.
+
+	The array is allocated once, so memory stays flat however long we acquire.
+	written and flushed are running counts of rows (the write and flush cursors),
+	the row for count n lives at data[n % capacity]. Rows between the two cursors
+	have not been handed to the file writer yet. If the writer falls a whole buffer
+	behind, new samples are dropped (and counted) rather than overwriting unflushed ones.
+	"""
+	def __init__(self, capacity=2**20):
+		self.capacity = capacity
+		self.written = 0
+		self.flushed = 0
+		self.dropped = 0
+		self.data = np.zeros(capacity, dtype=sampleDtype)
+
+	def free(self):
+		return self.capacity-(self.written-self.flushed)
+
+	def add(self,el,az,rev,t=None):
+		# t - sample time, defaults to now
+		if self.written-self.flushed>=self.capacity:
+			self.dropped = self.dropped+1
+			return False
+		if t is None:
+			t = timestamp()
+		self.data[self.written%self.capacity] = ((t,el,az,rev))
+		self.written = self.written+1
+		return True
 		
+	def addBlock(self,el,az,rev,t):
+		# add arrays of samples in one go (from a buffered read), t - array of sample times
+		# returns the number of samples added
+		n = min(len(rev), self.free())
+		self.dropped = self.dropped+len(rev)-n
+		start = self.written%self.capacity
+		first = min(n, self.capacity-start)		# rows that fit before the end of the array, the rest wrap to the start
+		for dest, src in ((self.data[start:start+first], slice(0, first)), (self.data[:n-first], slice(first, n))):
+			dest["t"], dest["el"], dest["az"], dest["rev"] = t[src], el[src], az[src], rev[src]
+		self.written = self.written+n
+		return n
+
+	def last(self):
+		# the most recently added row
+		return self.data[(self.written-1)%self.capacity]
+
 	def getData(self):
 		return self.data
+
+	def unflushed(self, upto=None):
+		# zero-copy views of the rows between the flush cursor and upto (default: the write cursor).
+		# One view, or two when the region wraps around the end of the array.
+		if upto is None:
+			upto = self.written
+		start, stop = self.flushed%self.capacity, self.flushed%self.capacity+(upto-self.flushed)
+		if stop<=self.capacity:
+			return [self.data[start:stop]]
+		return [self.data[start:], self.data[:stop-self.capacity]]
+
+	def markFlushed(self, upto=None):
+		# move the flush cursor, freeing the space for new samples
+		if upto is None:
+			upto = self.written
+		self.flushed = upto
 	
 	
+class flushThread(threading.Thread):
+	"""
+	Writes the collector's rows to disk from its own thread, so a slow write does not
+	stall the sampling loop.
+
+	The sampling loop calls handOff(), which puts the current write cursor on a bounded
+	queue. The thread writes the rows up to that cursor straight from the ring buffer
+	(no copy) and then moves the flush cursor. If the queue is full the hand-off is just
+	deferred to the next call, nothing is lost unless the ring buffer itself fills up,
+	which shows up in collector.dropped.
+	"""
+	def __init__(self, collector, writer, depth=16):
+		threading.Thread.__init__(self, name="encoderFlushThread")
+		self.daemon = True
+		self.collector = collector
+		self.writer = writer
+		self.queue = Queue.Queue(depth)
+		self.handedOff = collector.written	# write cursor of the last hand-off
+		self.deferred = 0			# hand-offs skipped because the queue was full
+
+	def handOff(self):
+		upto = self.collector.written
+		if upto==self.handedOff:
+			return True
+		try:
+			self.queue.put_nowait(upto)
+		except Queue.Full:
+			self.deferred = self.deferred+1
+			return False
+		self.handedOff = upto
+		return True
+
+	def queueDepth(self):
+		return self.queue.qsize()
+
+	def dropped(self):
+		return self.collector.dropped
+
+	def run(self):
+		while True:
+			upto = self.queue.get()
+			if upto is None:
+				break
+			for rows in self.collector.unflushed(upto):
+				self.writer.append(rows)
+			self.collector.markFlushed(upto)
+		self.writer.close()
+
+	def stop(self):
+		# write out everything collected so far, then end the thread
+		while not self.handOff():
+			time.sleep(0.01)
+		self.queue.put(None)
+		self.join()
+
+class acqStats(object):
+	"""
+	Running instrumentation of the acquisition loop.
+
+	Keeps histograms of the interval between samples, the time spent in each DAQ
+	read call and the time spent decoding and calibrating. Values are dropped into
+	preallocated arrays as they come (one array store per value) and folded into the
+	histograms in bulk. Every interval seconds, report() appends one JSON line with
+	the achieved rate, the histograms and their mean/max to MM-DD-YYYY/stats.txt,
+	next to the data files, and starts a new interval.
+
+	Histogram bins are log spaced from 1 us to 10 s, five per decade. Values outside that
+	range (zero intervals are common with a coarse clock) are counted in the first or last
+	bin, and separately as "under" and "over", so n and the mean cover every value.
+	"""
+	bins = np.logspace(-6, 1, 36)
+	kinds = ("interval", "read", "decode")
+
+	def __init__(self, interval=10., size=2**16):
+		self.interval = interval
+		self.pending = dict((kind, np.empty(size)) for kind in self.kinds)
+		self.nPending = dict((kind, 0) for kind in self.kinds)
+		self.lastT = None
+		self.reset(timestamp())
+
+	def reset(self, now):
+		self.start = now
+		self.samples = 0
+		self.hist = dict((kind, np.zeros(len(self.bins)-1, dtype=np.int64)) for kind in self.kinds)
+		self.count = dict((kind, 0) for kind in self.kinds)
+		self.under = dict((kind, 0) for kind in self.kinds)
+		self.over = dict((kind, 0) for kind in self.kinds)
+		self.total = dict((kind, 0.) for kind in self.kinds)
+		self.max = dict((kind, 0.) for kind in self.kinds)
+
+	def fold(self, kind, values=None):
+		# move the pending values of kind (or the given array) into the histogram
+		if values is None:
+			values = self.pending[kind][:self.nPending[kind]]
+			self.nPending[kind] = 0
+		if len(values):
+			self.hist[kind] += np.histogram(np.clip(values, self.bins[0], self.bins[-1]), self.bins)[0]
+			self.count[kind] += len(values)
+			self.under[kind] += int((values < self.bins[0]).sum())
+			self.over[kind] += int((values > self.bins[-1]).sum())
+			self.total[kind] += values.sum()
+			self.max[kind] = max(self.max[kind], values.max())
+
+	def record(self, kind, seconds):
+		n = self.nPending[kind]
+		if n==len(self.pending[kind]):
+			self.fold(kind)
+			n = 0
+		self.pending[kind][n] = seconds
+		self.nPending[kind] = n+1
+
+	def sampleTimes(self, t):
+		# t - time of one sample, or an array of sample times in order
+		t = np.atleast_1d(t)
+		if self.lastT is not None:
+			if len(t)==1:
+				self.record("interval", t[0]-self.lastT)
+			else:
+				self.fold("interval", np.diff(np.concatenate(([self.lastT], t))))
+		self.lastT = t[-1]
+		self.samples += len(t)
+
+	def due(self, now):
+		return now-self.start>=self.interval
+
+	def report(self, now, **extra):
+		# write the stats record for the interval ending now, extra fields are included as given
+		for kind in self.kinds:
+			self.fold(kind)
+		elapsed = max(now-self.start, 1e-9)		# report() right after reset(), at a quick shutdown
+		record = {"time": now, "seconds": now-self.start, "samples": self.samples,
+			"rate": self.samples/elapsed, "bins": list(self.bins)}
+		for kind in self.kinds:
+			n = self.count[kind]
+			record[kind] = {"hist": self.hist[kind].tolist(), "n": n, "under": self.under[kind], "over": self.over[kind],
+				"mean": n and self.total[kind]/n, "max": self.max[kind]}
+		record.update(extra)
+		path = os.path.join(os.path.dirname(filePath(dt.datetime.fromtimestamp(now))), "stats.txt")
+		with open(path, "a") as fp:
+			fp.write(json.dumps(record)+"\n")
+		self.reset(now)
+		return record
+
+	
 if __name__=='__main__':
 	'''print(bcd_to_int('101001000000000001'))
 	print(bin_to_int('0011'))
@@ -74,42 +398,60 @@ if __name__=='__main__':
 	data[1]=all
 	fileStruct(data)
 	'''
-	if len(sys.argv)==1: #this is the defualt no argument write time
-		sys.argv.append(60)
+	if len(sys.argv)==1: #this is the defualt no argument write time, in seconds
+		sys.argv.append(1)
 	#data = np.zeros(1000, dtype=[("first", np.int), ("second", np.int)])
-	eye = getData.Eyeball()
+	buffered = len(sys.argv)>2	#optional second argument: hardware timed sample rate in Hz
+	if buffered:
+		eye = getData.BufferedEyeball(rate=float(sys.argv[2]))
+	else:
+		eye = getData.Eyeball()
 	Data = datacollector()
+	cal = calibration()
+	flusher = flushThread(Data, fileWriter(Data.data.dtype, attrs=cal.attrs()))
+	flusher.start()
+	stats = acqStats()
 
 	#fileStruct(Data.getData())
 
-	time_a = time.time()
-	while True:
-		#timer loop
-		all = eye.getData()
-		
-		all = (bcd_to_int(all[0]), bin_to_int(all[1]), bin_to_int(all[2]))
-		
-		el=eloffset+elgain*all[0]
-		az=np.mod(azoffset + azgain*all[1],360.)
-		rev=all[2]
-		Data.add(el,az,rev)
-		#print Data.getData()
-		time_b = time.time()
-		delta = time_b-time_a
-		if (delta>=2):
-			print rev,az,el
-		if(delta>=int(sys.argv[1])): 
-			fileStruct(Data.getData(), Data)
-			time_a=time.time();
-			print "file written"
-			
-	print "data collected at" + str(1.0/delta) +"HZ"
-		
-		
-	
-		
-		#print delta
-		
-		#time.sleep(.03-delta)
-		
-		
\ No newline at end of file
+	time_start = time_a = time.time()
+	try:
+		while True:
+			#timer loop
+			t_read = timer()
+			if buffered:
+				lines = eye.getBlock()
+				t_decode = timer()
+				elCode, azCode, rev = decoder.decode(lines)
+				t = eye.sampleTimes(len(rev))
+				Data.addBlock(cal.elTable[elCode], cal.azTable[azCode], rev, t)
+			else:
+				lines = eye.getLines()
+				t_decode = timer()
+				t = timestamp()
+				elCode, azCode, rev = decoder.decode(lines)
+				
+				el=cal.elTable[elCode]
+				az=cal.azTable[azCode]
+				Data.add(el,az,rev,t)
+			t_done = timer()
+			stats.record("read", t_decode-t_read)
+			stats.record("decode", t_done-t_decode)
+			stats.sampleTimes(t)
+			now = timestamp()
+			if stats.due(now):
+				stats.report(now, queueDepth=flusher.queueDepth(), deferred=flusher.deferred, dropped=flusher.dropped())
+			#print Data.getData()
+			time_b = time.time()
+			delta = time_b-time_a
+			if(delta>=float(sys.argv[1])): 
+				flusher.handOff()
+				time_a=time.time();
+				t, el, az, rev = Data.last()
+				print rev,az,el, "queue depth", flusher.queueDepth(), "dropped", flusher.dropped()
+	except KeyboardInterrupt:
+		pass
+	flusher.stop()
+	eye.close()
+	stats.report(timestamp(), queueDepth=flusher.queueDepth(), deferred=flusher.deferred, dropped=flusher.dropped())
+	print "data collected at " + str(Data.written/(time.time()-time_start)) +"HZ"
@@ -0,0 +1,102 @@
+"""
+Vectorized decoding of raw DIO line buffers into encoder counts.
+
+DAQmxReadDigitalLines hands back one uint8 (0 or 1) per line. The lines come
+out in the order the channels are created in getData.Eyeball:
+
+	port10, port7, port4, port2, port5, port0, port3, port9
+
+so line Pk.j sits at index 8*(position of port k) + j. See getData.py for the
+mapping of DIO lines onto the encoder connectors.
+
+Every output value is a linear combination of line bits:
+	- the azimuth encoder and the 24 bit counter are natural binary, each bit
+	  weighs a power of two
+	- the elevation encoder is BCD (one 2 bit digit and four 4 bit digits), so a
+	  bit weighs 2**(bit within its digit) * 10**(digit position)
+This means one dot product of the line buffer with a (64, 3) weight matrix
+decodes all three values, for a single sample or a whole block of samples.
+"""
+import numpy as np
+
+LINES_PER_SAMPLE = 64
+
+def _portIndex(port, line):
+	# index in the line buffer of DIO line P<port>.<line>
+	return 8*[10, 7, 4, 2, 5, 0, 3, 9].index(port) + line
+
+# Line buffer indices of each value, MSB first (same order as the strings built by getData.Eyeball.getData)
+EL_LINES = [_portIndex(10, l) for l in range(7, 1, -1)] + \
+	[_portIndex(7, l) for l in range(7, 1, -1)] + \
+	[_portIndex(4, l) for l in range(7, 1, -1)]
+AZ_LINES = [_portIndex(2, l) for l in range(7, -1, -1)] + \
+	[_portIndex(5, l) for l in range(7, -1, -1)]
+COUNTER_LINES = [_portIndex(0, l) for l in range(7, -1, -1)] + \
+	[_portIndex(3, l) for l in range(7, -1, -1)] + \
+	[_portIndex(9, l) for l in range(7, -1, -1)]
+
+EL_DIGIT_BITS = (2, 4, 4, 4, 4)		# BCD digit widths, most significant digit first. Max value 39999
+EL_CODES = 40000
+AZ_CODES = 2**16
+COUNTER_CODES = 2**24
+
+def _bcdWeights(digitBits):
+	weights = []
+	for digit, nBits in enumerate(digitBits):
+		decade = 10**(len(digitBits) - 1 - digit)
+		weights.extend([decade * 2**b for b in range(nBits - 1, -1, -1)])
+	return weights
+
+def _buildWeights():
+	weights = np.zeros((LINES_PER_SAMPLE, 3), dtype=np.int64)
+	weights[EL_LINES, 0] = _bcdWeights(EL_DIGIT_BITS)
+	weights[AZ_LINES, 1] = [2**b for b in range(len(AZ_LINES) - 1, -1, -1)]
+	weights[COUNTER_LINES, 2] = [2**b for b in range(len(COUNTER_LINES) - 1, -1, -1)]
+	return weights
+
+WEIGHTS = _buildWeights()
+
+def decodeBlock(lines):
+	# lines - uint8 array of shape (nSamples, >= 64), one row per sample
+	# returns an int64 array of shape (nSamples, 3) with columns (el, az, counter)
+	lines = np.asarray(lines)
+	return np.dot(lines[..., :LINES_PER_SAMPLE].astype(np.int64), WEIGHTS)
+
+def decode(lines):
+	# Decode one sample (1-D line buffer) into python ints, or a block of samples (2-D)
+	# into arrays.
+	# returns el counts, az counts, counter
+	codes = decodeBlock(lines)
+	if codes.ndim == 1:
+		return int(codes[0]), int(codes[1]), int(codes[2])
+	return codes[:, 0], codes[:, 1], codes[:, 2]
+
+def _buildEncoding():
+	# For each line: which value it carries, and how to get its bit out of that value:
+	# bit = (value // divisor) % modulus >> shift & 1
+	column = np.zeros(LINES_PER_SAMPLE, dtype=np.int64)
+	divisor = np.ones(LINES_PER_SAMPLE, dtype=np.int64)
+	modulus = np.ones(LINES_PER_SAMPLE, dtype=np.int64)	# unused lines always read 0
+	shift = np.zeros(LINES_PER_SAMPLE, dtype=np.int64)
+	i = 0
+	for digit, nBits in enumerate(EL_DIGIT_BITS):
+		for b in range(nBits - 1, -1, -1):
+			divisor[EL_LINES[i]] = 10**(len(EL_DIGIT_BITS) - 1 - digit)
+			modulus[EL_LINES[i]] = 10
+			shift[EL_LINES[i]] = b
+			i += 1
+	for col, lines in ((1, AZ_LINES), (2, COUNTER_LINES)):
+		column[lines] = col
+		modulus[lines] = 2**len(lines)
+		shift[lines] = range(len(lines) - 1, -1, -1)
+	return column, divisor, modulus, shift
+
+_ENCODING = _buildEncoding()
+
+def encode(el, az, counter):
+	# Inverse of decode: build the line buffers the DIO card would read for the given
+	# el counts (0-39999), az counts and counter values. Used by the simulated DAQ.
+	# returns a uint8 array of shape (nSamples, 64), or (64,) for scalar inputs
+	column, divisor, modulus, shift = _ENCODING
+	values = np.stack(np.broadcast_arrays(el, az, counter), axis=-1).astype(np.int64)
+	return (values[..., column] // divisor % modulus >> shift & 1).astype(np.uint8)
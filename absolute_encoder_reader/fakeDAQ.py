@@ -0,0 +1,72 @@
+"""
+Simulated stand-ins for getData.Eyeball and getData.BufferedEyeball, for running and
+benchmarking the encoder reader on a machine without NI-DAQmx.
+
+The line buffers are built with decoder.encode from a simulated telescope: the
+azimuth spins at a constant rate, the elevation nods up and down, and the 24 bit
+counter counts a counterRate Hz clock and rolls over at 2**24. noise is the
+probability per sample that each encoder reading is off by one count.
+"""
+import time
+import numpy as np
+import decoder
+
+class Eyeball(object):
+	def __init__(self, azSpeed=5., elCenter=20000, elAmplitude=5000, elPeriod=60., counterRate=1e6, counterStart=2**24-10**6, noise=0., seed=None):
+		self.azSpeed = azSpeed
+		self.elCenter = elCenter
+		self.elAmplitude = elAmplitude
+		self.elPeriod = elPeriod
+		self.counterRate = counterRate
+		self.counterStart = counterStart
+		self.noise = noise
+		self.random = np.random.RandomState(seed)
+		self.tStart = time.time()
+
+	def configTiming(self):
+		pass
+
+	def close(self):
+		print "bye"
+
+	def frames(self, t):
+		# line buffers seen at times t (seconds since the start)
+		t = np.asarray(t, dtype=np.float64)
+		az = np.floor(self.azSpeed*t/360.*decoder.AZ_CODES).astype(np.int64)
+		el = np.round(self.elCenter+self.elAmplitude*np.sin(2*np.pi*t/self.elPeriod)).astype(np.int64)
+		if self.noise:
+			az = az+(self.random.random_sample(t.shape)<self.noise)*self.random.choice((-1, 1), t.shape)
+			el = el+(self.random.random_sample(t.shape)<self.noise)*self.random.choice((-1, 1), t.shape)
+		counter = (self.counterStart+np.floor(t*self.counterRate).astype(np.int64))%decoder.COUNTER_CODES
+		return decoder.encode(np.clip(el, 0, decoder.EL_CODES-1), az%decoder.AZ_CODES, counter)
+
+	def getLines(self):
+		return self.frames(time.time()-self.tStart)
+
+	def getData(self):
+		# same strings as the real getData.Eyeball.getData
+		lines = map(str, self.getLines())
+		return [''.join(lines[i] for i in l) for l in (decoder.EL_LINES, decoder.AZ_LINES, decoder.COUNTER_LINES)]
+
+class BufferedEyeball(Eyeball):
+	# Samples on a simulated sample clock. getBlock waits until the block would have been
+	# acquired, like the real card does. rate=None hands blocks back as fast as they can
+	# be generated (with the sample times still spaced as if acquired at maxRate).
+	def __init__(self, rate=10000., sampsPerRead=1000, maxRate=1e6, **kwargs):
+		Eyeball.__init__(self, **kwargs)
+		self.rate = rate
+		self.sampleRate = float(rate or maxRate)
+		self.sampsPerRead = int(sampsPerRead)
+		self.samplesRead = 0
+
+	def getBlock(self):
+		t = np.arange(self.samplesRead, self.samplesRead+self.sampsPerRead)/self.sampleRate
+		if self.rate:
+			wait = self.tStart+t[-1]-time.time()
+			if wait>0:
+				time.sleep(wait)
+		self.samplesRead += self.sampsPerRead
+		return self.frames(t)
+
+	def sampleTimes(self, n):
+		return self.tStart + np.arange(self.samplesRead - n, self.samplesRead)/self.sampleRate
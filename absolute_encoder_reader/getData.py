@@ -1,6 +1,8 @@
 from PyDAQmx import *
 from PyDAQmx.DAQmxCallBack import *
 from numpy import zeros
+import decoder
+import time
 """ 
 functions to get DIO data and parse in to Az encoder, El encoder and 24 bit counter numbers
 Mappings to DIO board  P
@@ -38,8 +40,14 @@ class Eyeball(object):
 		DAQmxCreateDIChan(self.taskHandle,"Dev1/port3","",DAQmx_Val_ChanForAllLines)
 		DAQmxCreateDIChan(self.taskHandle,"Dev1/port9","",DAQmx_Val_ChanForAllLines)
 		
+		self.configTiming()
 		DAQmxStartTask(self.taskHandle)
 
+	def configTiming(self):
+		# Called after the channels are created and before the task is started.
+		# The plain Eyeball does on-demand (software timed) reads, so there is nothing to set up.
+		pass
+
 	def close(self):
 		print "bye"
 		
@@ -50,6 +58,12 @@ class Eyeball(object):
 		#self.close()
 		pass
 
+	def getLines(self):
+		# Read one sample and return the raw line buffer (one uint8 per line).
+		# Decode it with decoder.decode instead of going through strings.
+		DAQmxReadDigitalLines(self.taskHandle,1,10.0,DAQmx_Val_GroupByChannel,self.data,self.data.shape[0],byref(self.read),byref(self.bytesPerSamp),None)
+		return self.data
+
 	def getData(self):
 		
 		DAQmxReadDigitalLines(self.taskHandle,1,10.0,DAQmx_Val_GroupByChannel,self.data,100,byref(self.read),byref(self.bytesPerSamp),None)
@@ -59,6 +73,60 @@ class Eyeball(object):
 
 		return  [''.join((all[2:8])[::-1])+''.join((all[10:16])[::-1])+''.join((all[18:24])[::-1]), ''.join((all[24:32])[::-1])+"".join((all[32:40])[::-1]), ''.join((all[40:48])[::-1])+''.join((all[48:56])[::-1])+''.join((all[56:64])[::-1])]
 
+
+class BufferedEyeball(Eyeball):
+	"""
+	Hardware timed acquisition. The DIO task runs off a sample clock and the card
+	buffers the samples, so sample timing no longer depends on how fast python loops.
+	Each read returns a block of samples, one row of lines per sample, ready for
+	decoder.decode.
+
+	rate          - sample clock rate in Hz
+	sampsPerRead  - number of samples returned by each getBlock call
+	clockSource   - terminal of the sample clock, "" uses the onboard clock
+	bufferSecs    - size of the card-side buffer, in seconds of data
+	callback      - optional function(block, firstSample). If given, it is called from
+	                a DAQmx every-N-samples event with each new block, instead of
+	                polling getBlock
+	"""
+	def __init__(self, rate=10000., sampsPerRead=1000, clockSource="", bufferSecs=10., callback=None):
+		self.rate = float(rate)
+		self.sampsPerRead = int(sampsPerRead)
+		self.clockSource = clockSource
+		self.bufferSize = max(int(self.rate*bufferSecs), 2*self.sampsPerRead)
+		self.callback = callback
+		self.samplesRead = 0		# total samples read since the task started, gives the time of each sample
+		self.block = numpy.zeros((self.sampsPerRead, decoder.LINES_PER_SAMPLE), dtype=numpy.uint8)
+		Eyeball.__init__(self)
+
+	def configTiming(self):
+		self.tStart = time.time()	# the task is started right after this, sample times count from here
+		DAQmxCfgSampClkTiming(self.taskHandle, self.clockSource, self.rate, DAQmx_Val_Rising, DAQmx_Val_ContSamps, self.bufferSize)
+		if self.callback is not None:
+			# keep references to the ctypes callback and its data id, or they get garbage collected under DAQmx
+			self.callbackId = create_callbackdata_id(self)
+			self.callbackPtr = DAQmxEveryNSamplesEventCallbackPtr(_everyNCallback)
+			DAQmxRegisterEveryNSamplesEvent(self.taskHandle, DAQmx_Val_Acquired_Into_Buffer, self.sampsPerRead, 0, self.callbackPtr, self.callbackId)
+
+	def getBlock(self):
+		# Read the next sampsPerRead samples (waits for them if they are not in the buffer yet).
+		# GroupByScanNumber interleaves the lines, so the block is one row per sample.
+		# Returns a view of the preallocated block, it is overwritten by the next read.
+		DAQmxReadDigitalLines(self.taskHandle,self.sampsPerRead,10.0,DAQmx_Val_GroupByScanNumber,self.block,self.block.size,byref(self.read),byref(self.bytesPerSamp),None)
+		self.samplesRead += self.read.value
+		return self.block[:self.read.value]
+
+	def sampleTimes(self, n):
+		# times (seconds since the epoch) of the last n samples read, from the sample clock
+		return self.tStart + numpy.arange(self.samplesRead - n, self.samplesRead)/self.rate
+
+def _everyNCallback(taskHandle, eventType, nSamples, callbackData):
+	eye = get_callbackdata_from_id(callbackData)
+	first = eye.samplesRead
+	block = eye.getBlock()
+	eye.callback(block, first)
+	return 0		# DAQmx wants an int32 status back
+
 	
 if __name__=='__main__':
 	t = Eyeball()
@@ -0,0 +1,159 @@
+"""
+Raw spool capture for the highest rate runs.
+
+Capture appends the undecoded DIO frames, with their sample time, to a memory mapped
+spool file of fixed size records. The capture loop does no decoding and no HDF5
+calls, only a copy of each block into the map, so the capture rate does not depend
+on calibration or the storage format. Spools are converted to the usual calibrated
+HDF5 files afterwards with the vectorized decoder.
+
+	python spool.py capture [rate in Hz] [samples per read]
+	python spool.py convert file.spool [file.spool ...]
+
+Spool file layout: a 64 byte header (magic, version, record size, record count)
+followed by records of a float64 time and the 64 line bytes. The count in the header
+is updated on every flush and on close. A spool that was not closed cleanly is still
+readable: the records after the count whose time is set are picked up as well.
+"""
+import os
+import sys
+import time
+import datetime as dt
+import numpy as np
+import decoder
+import converter
+
+MAGIC = "EYESPOOL"
+VERSION = 1
+HEADER_SIZE = 64
+headerDtype = np.dtype([("magic", "S8"), ("version", "<u4"), ("recordSize", "<u4"), ("count", "<u8")])
+recordDtype = np.dtype([("t", "<f8"), ("lines", np.uint8, decoder.LINES_PER_SAMPLE)])
+
+def spoolPath(t, n=0):
+	# MM-DD-YYYY/HH-MM-SS-NNNN.spool for the given datetime and sequence number, next to the HDF5 files
+	return os.path.join(os.path.dirname(converter.filePath(t)), "%s-%04d.spool" % (t.strftime("%H-%M-%S"), n))
+
+class spoolWriter(object):
+	"""
+	Appends frames to memory mapped spool files of capacity records each, starting a
+	new file when one fills up. flush() every so often to push the header count (and the
+	mapped pages) to disk.
+	"""
+	def __init__(self, capacity=2**22):
+		self.capacity = capacity
+		self.records = None
+		self.count = 0
+		self.total = 0
+
+	def open(self):
+		self.close()
+		t = dt.datetime.now()
+		n = 0
+		self.path = spoolPath(t)
+		while os.path.exists(self.path):	# more than one spool started in the same second, the sequence number keeps them in order
+			n += 1
+			self.path = spoolPath(t, n)
+		with open(self.path, "wb") as fp:
+			fp.truncate(HEADER_SIZE+self.capacity*recordDtype.itemsize)	# sparse, pages are allocated as they are written
+		self.header = np.memmap(self.path, dtype=headerDtype, mode="r+", shape=(1,))
+		self.header[0] = (MAGIC, VERSION, recordDtype.itemsize, 0)
+		self.records = np.memmap(self.path, dtype=recordDtype, mode="r+", offset=HEADER_SIZE, shape=(self.capacity,))
+		self.count = 0
+
+	def add(self, lines, t):
+		# one frame
+		if self.records is None or self.count==self.capacity:
+			self.open()
+		record = self.records[self.count]
+		record["lines"] = lines[:decoder.LINES_PER_SAMPLE]
+		record["t"] = t
+		self.count += 1
+		self.total += 1
+
+	def addBlock(self, lines, t):
+		# a block of frames, one row of lines per frame, t - array of sample times
+		done = 0
+		while done<len(t):
+			if self.records is None or self.count==self.capacity:
+				self.open()
+			n = min(len(t)-done, self.capacity-self.count)
+			dest = self.records[self.count:self.count+n]
+			dest["lines"] = lines[done:done+n, :decoder.LINES_PER_SAMPLE]
+			dest["t"] = t[done:done+n]
+			self.count += n
+			self.total += n
+			done += n
+
+	def flush(self):
+		if self.records is not None:
+			self.header[0]["count"] = self.count
+			self.records.flush()
+			self.header.flush()
+
+	def close(self):
+		if self.records is not None:
+			self.flush()
+			del self.records, self.header		# unmap before truncating the unused space off the end
+			self.records = None
+			with open(self.path, "r+b") as fp:
+				fp.truncate(HEADER_SIZE+self.count*recordDtype.itemsize)
+
+def readSpool(path):
+	# the records of a spool file, as a read-only memory mapped array
+	header = np.fromfile(path, dtype=headerDtype, count=1)[0]
+	if header["magic"]!=MAGIC or header["recordSize"]!=recordDtype.itemsize:
+		raise ValueError, "%s is not a version %d spool file" % (path, VERSION)
+	capacity = (os.path.getsize(path)-HEADER_SIZE)//recordDtype.itemsize
+	if not capacity:
+		return np.zeros(0, dtype=recordDtype)
+	records = np.memmap(path, dtype=recordDtype, mode="r", offset=HEADER_SIZE, shape=(capacity,))
+	count = int(header["count"])
+	unset = np.flatnonzero(records["t"][count:]==0)		# records past the count written before a crash
+	count += unset[0] if len(unset) else capacity-count
+	return records[:count]
+
+def firstTime(path):
+	# time of the first record in a spool, for putting spools in order (inf if it is empty)
+	records = readSpool(path)
+	return records["t"][0] if len(records) else float("inf")
+
+def convert(path, cal, writer, block=2**16):
+	# decode and calibrate a spool into HDF5 through writer, returns the number of samples
+	records = readSpool(path)
+	for start in range(0, len(records), block):
+		chunk = records[start:start+block]
+		elCode, azCode, rev = decoder.decode(chunk["lines"])
+		rows = np.empty(len(chunk), dtype=converter.sampleDtype)
+		rows["t"], rows["el"], rows["az"], rows["rev"] = chunk["t"], cal.elTable[elCode], cal.azTable[azCode], rev
+		writer.append(rows)
+	return len(records)
+
+def capture(rate, sampsPerRead, flushEvery=1.):
+	eye = converter.getData.BufferedEyeball(rate=rate, sampsPerRead=sampsPerRead)
+	spool = spoolWriter()
+	time_a = time_start = time.time()
+	try:
+		while True:
+			lines = eye.getBlock()
+			spool.addBlock(lines, eye.sampleTimes(len(lines)))
+			if time.time()-time_a>=flushEvery:
+				spool.flush()
+				time_a = time.time()
+				print spool.path, spool.count
+	except KeyboardInterrupt:
+		pass
+	spool.close()
+	eye.close()
+	print "spooled at " + str(spool.total/(time.time()-time_start)) +"HZ"
+
+if __name__=='__main__':
+	if len(sys.argv)>1 and sys.argv[1]=="convert":
+		cal = converter.calibration()
+		writer = converter.fileWriter(converter.sampleDtype, attrs=cal.attrs())
+		for path in sorted(sys.argv[2:], key=firstTime):	# the writer appends, so in time order whatever order the shell gives
+			print path, convert(path, cal, writer), "samples"
+		writer.close()
+	elif len(sys.argv)>1 and sys.argv[1]=="capture":
+		capture(float(sys.argv[2]) if len(sys.argv)>2 else 10000., int(sys.argv[3]) if len(sys.argv)>3 else 1000)
+	else:
+		print __doc__
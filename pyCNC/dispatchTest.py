@@ -0,0 +1,111 @@
+'''
+
+Concurrency check for the GalilInterface command dispatchers, against a simulated galil.
+
+	python dispatchTest.py [threads] [commands per thread]
+
+Starts a small TCP server that answers like the galil does (":" per command, MG echoes its
+argument, WH names a handle) on two consecutive ports, opens a GalilInterface on it, and
+has every thread send interleaved commands:
+
+	sendOnly("SPA=n")		motion handle, acknowledgement only
+	sendAndRecieve("MG n")		query handle
+	motion.sendAndRecieve("MG n")	motion handle, behind the SP acknowledgements
+
+Each MG reply has to come back to the thread that sent it. Prints the number that did not,
+and exits with 1 if there were any.
+
+'''
+
+import sys
+import time
+import socket
+import threading
+
+import galilInterface
+
+def serve(con):
+	# answer the commands on one connection until it closes
+	buf = ""
+	while True:
+		try:
+			dat = con.recv(4096)
+		except socket.error:
+			return
+		if not dat:
+			return
+		buf += dat
+		while "\r" in buf:
+			line, buf = buf.split("\r", 1)
+			for cmd in line.split(";"):
+				cmd = cmd.strip()
+				if not cmd:
+					continue
+				if cmd.startswith("MG"):
+					con.sendall(" %s\r\n:" % cmd[2:].strip())
+				elif cmd.startswith("WH"):
+					con.sendall("IHA\r\n:")
+				else:
+					con.sendall(":")
+
+def accept(listener):
+	while True:
+		con, addr = listener.accept()
+		th = threading.Thread(target = serve, args = (con,))
+		th.daemon = True
+		th.start()
+
+def fakeGalil():
+	# listen on two consecutive ports (the interface opens port and port+1), returns the first
+	while True:
+		listeners = [socket.socket(), socket.socket()]
+		listeners[0].bind(("127.0.0.1", 0))
+		port = listeners[0].getsockname()[1]
+		try:
+			listeners[1].bind(("127.0.0.1", port+1))
+		except socket.error:
+			for listener in listeners:
+				listener.close()
+			continue
+		for listener in listeners:
+			listener.listen(5)
+			th = threading.Thread(target = accept, args = (listener,))
+			th.daemon = True
+			th.start()
+		return port
+
+def run(threads = 4, count = 200):
+	# returns (mismatched replies, seconds taken)
+	gInt = galilInterface.GalilInterface("127.0.0.1", fakeGalil(), unsol = False, download = False)
+	bad = [0]
+
+	def worker(k):
+		for i in range(count):
+			n = k*100000 + i
+			if i % 3 == 0:
+				gInt.sendOnly("SPA=%d" % i, debug = False)
+			if i % 2:
+				ret = gInt.motion.sendAndRecieve("MG %d" % n, debug = False)
+			else:
+				ret = gInt.sendAndRecieve("MG %d" % n, debug = False)
+			if ret != str(n):
+				bad[0] += 1
+
+	workers = [threading.Thread(target = worker, args = (k,)) for k in range(threads)]
+	start = time.time()
+	for th in workers:
+		th.start()
+	for th in workers:
+		th.join()
+	elapsed = time.time() - start
+
+	gInt.close(motorsOff = False)
+	return bad[0], elapsed
+
+if __name__ == "__main__":
+	threads = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+	count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+	bad, elapsed = run(threads, count)
+	print "%d threads, %d commands: %d replies to the wrong caller, %.2f s" % (threads, threads*count, bad, elapsed)
+	sys.exit(1 if bad else 0)
@@ -0,0 +1,207 @@
+'''
+
+Throughput benchmark for the data record parsers in drParse.
+
+	python drBench.py [seconds per run] [output file]
+
+Synthesizes data records for a set of DR configurations and, for each one, times every
+parser path:
+
+	lazy		parseDataRecord, no blocks touched
+	posvel		parseDataRecord, then the I block and the A and B axis blocks read
+	state		parseDataRecord, then state("IAB"), and SN and the A and B status, position
+			and velocity read from it (what GalilInterface.pollUDP does with each record)
+	dict		parseDataRecord(...).toDict(), everything decoded (what the old parser returned)
+	batch		parseDataRecords on batches of records, per record
+
+Each result is one line of JSON (records/s, us per record, allocations per record, and the
+fraction of one core a 1 kHz DR rate would take), printed, and appended to the output
+file if one is given, so runs from before and after a parser change can be compared.
+
+Python 2 has no allocation tracing, and the gc does not track dicts and tuples that only
+hold ints and strings (the blocks toDict builds, for one), so allocations are counted by
+keeping the results alive and walking them: every distinct object reachable from them is
+one allocation, except the input packets, the cached layouts and the objects python
+shares (small ints, None). That sees every container, int and string the parsers build,
+but counts an array as one object, whatever its size, and misses temporaries freed
+before the parser returns.
+
+'''
+
+import sys
+import time
+import json
+import struct
+import random
+import platform
+
+import drParse
+
+# (name, flags), flags as parseDataRecord sees them after the byte swap.
+# bits 0 - 7 axis blocks A - H, 8 and 9 the S and T blocks, 10 the I block
+configs = [
+	("I",			1<<10),
+	("I+A+B",		1<<10 | 0x03),
+	("I+A-H",		1<<10 | 0xFF),
+	("I+S+T+A+B",	1<<10 | 1<<8 | 1<<9 | 0x03),
+	("I+S+T+A-H",	1<<10 | 1<<8 | 1<<9 | 0xFF),
+]
+
+BATCH = 1000		# records per parseDataRecords call
+
+def makeRecord(flags, rand = random):
+	# one data record with the given flags and random contents, as the galil sends it
+	body = ""
+	if flags & 1<<10:
+		body += struct.pack(drParse.iBlkParseStr, rand.randint(0, 65535), *[rand.randint(0, 255) for x in range(22)])
+	for bit in (8, 9):
+		if flags & 1<<bit:
+			body += struct.pack(drParse.stBlkParseStr, rand.randint(0, 65535), rand.randint(0, 65535), rand.randint(-2**31, 2**31-1))
+	for axis in range(8):
+		if flags & 1<<axis:
+			body += struct.pack(drParse.axBlkParseStr, rand.randint(0, 65535), rand.randint(0, 255), rand.randint(0, 255),
+					*[rand.randint(-2**31, 2**31-1) for x in range(5)] + [rand.randint(-2**15, 2**15-1) for x in range(2)])
+	wireFlags = (flags / 2**8) + ((flags % 2**8) * 2**8)		# byte swapped, see parseDataRecord
+	return struct.pack("<HH", wireFlags, len(body)+4) + body
+
+def benchLazy(recs):
+	for r in recs:
+		drParse.parseDataRecord(r)
+	return len(recs)
+
+def benchPosVel(recs):
+	for r in recs:
+		rec = drParse.parseDataRecord(r)
+		if "I" in rec:
+			rec.I.SN
+		if "A" in rec:
+			rec.A.motorPos, rec.A.vel, rec.B.motorPos, rec.B.vel
+	return len(recs)
+
+def benchState(recs):
+	for r in recs:
+		rec = drParse.parseDataRecord(r)
+		state = rec.state("IAB")
+		for name in "IAB":
+			i = rec.stateIndex(name, "IAB")
+			if i is not None:
+				state[i]
+	return len(recs)
+
+def benchDict(recs):
+	for r in recs:
+		drParse.parseDataRecord(r).toDict()
+	return len(recs)
+
+def benchBatch(recs):
+	buf = "".join(recs)
+	size = len(recs[0])
+	for start in range(0, len(buf), BATCH*size):
+		drParse.parseDataRecords(buf[start:start+BATCH*size])
+	return len(recs)
+
+benches = [("lazy", benchLazy), ("posvel", benchPosVel), ("state", benchState), ("dict", benchDict), ("batch", benchBatch)]
+
+def collect(bench, recs):
+	# bench, but keeping whatever the parsers return, so it can be counted
+	keep = []
+	if bench is benchBatch:
+		buf = "".join(recs)
+		size = len(recs[0])
+		for start in range(0, len(buf), BATCH*size):
+			keep.append(drParse.parseDataRecords(buf[start:start+BATCH*size]))
+	elif bench is benchDict:
+		keep = [drParse.parseDataRecord(r).toDict() for r in recs]
+	elif bench is benchState:
+		for r in recs:
+			rec = drParse.parseDataRecord(r)
+			keep.append((rec, rec.state("IAB")))
+	else:
+		for r in recs:
+			rec = drParse.parseDataRecord(r)
+			if bench is benchPosVel:
+				for name in rec.blocks():
+					if name in "IAB":
+						rec[name]
+			keep.append(rec)
+	return keep
+
+def reachable(roots, known = ()):
+	# ids of the distinct objects reachable from roots that are not in known (a set of ids)
+	seen = set(known)
+	found = set()
+	stack = list(roots)
+	while stack:
+		obj = stack.pop()
+		if id(obj) in seen:
+			continue
+		seen.add(id(obj))
+		if obj is None or type(obj) is bool or (type(obj) is int and -5 <= obj <= 256):
+			continue				# shared by the interpreter, never allocated
+		found.add(id(obj))
+		if isinstance(obj, dict):
+			stack.extend(obj.keys())
+			stack.extend(obj.values())
+		elif isinstance(obj, (list, tuple)):
+			stack.extend(obj)
+		elif isinstance(obj, drParse.DataRecord):
+			for name in drParse.DataRecord.__slots__:
+				try:
+					stack.append(drParse.DataRecord.__dict__[name].__get__(obj))	# not getattr, that would decode the block
+				except AttributeError:
+					pass
+	return found
+
+def allocations(bench, recs):
+	# (allocations per record, method)
+	keep = collect(bench, recs)
+	known = set(id(r) for r in recs)
+	known.update(reachable(drParse.layoutCache.values()))	# built once per flags value, not per record
+	count = len(reachable(keep, known))
+	return float(count)/len(recs), "reachable"
+
+def run(seconds, bench, recs):
+	# call bench(recs) until seconds have passed, returns (records, elapsed seconds)
+	n = 0
+	t0 = time.time()
+	while time.time()-t0 < seconds:
+		n += bench(recs)
+	return n, time.time()-t0
+
+def benchmark(seconds = 2., nRecords = 10000, seed = 0):
+	# yields a result dict per configuration and parser path
+	rand = random.Random(seed)
+	for name, flags in configs:
+		recs = [makeRecord(flags, rand) for x in range(nRecords)]
+		for benchName, bench in benches:
+			n, elapsed = run(seconds, bench, recs)
+			allocs, allocMethod = allocations(bench, recs)
+			yield dict(
+				bench = benchName,
+				config = name,
+				flags = flags,
+				recordSize = len(recs[0]),
+				records = n,
+				seconds = round(elapsed, 4),
+				recordsPerSec = round(n/elapsed, 1),
+				usPerRecord = round(1e6*elapsed/n, 3),
+				coreAt1kHz = round(1000.*elapsed/n, 5),
+				allocsPerRecord = round(allocs, 3),
+				allocMethod = allocMethod,
+				python = platform.python_version(),
+				time = time.time(),
+			)
+
+if __name__ == "__main__":
+	seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 2.
+	out = open(sys.argv[2], "a") if len(sys.argv) > 2 else None
+
+	for result in benchmark(seconds):
+		line = json.dumps(result, sort_keys = True)
+		print line
+		if out:
+			out.write(line + "\n")
+			out.flush()
+
+	if out:
+		out.close()
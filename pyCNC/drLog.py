@@ -0,0 +1,183 @@
+'''
+
+Binary capture log of Galil data records.
+
+Every datagram received is stored as is, behind a small prefix, so logging a record is
+a single write and nothing is formatted or parsed on the way in.
+
+File layout:
+
+	8 bytes		magic, "GALILDR1"
+	then, for every datagram:
+	<d			receive time (seconds since the epoch)
+	<H			datagram length
+				the datagram
+
+Next to the log, <log>.idx is a sparse time index: every indexEvery seconds the writer
+appends the time and byte offset of the record it is writing ("<dQ"). A reader binary
+searches it to seek by time. If the index is missing (or behind the log) it is rebuilt
+by scanning the log.
+
+The writer flushes both files every flushEvery seconds or flushRecords records, whichever
+comes first, so a crash loses at most that much of the tail.
+
+'''
+
+import os
+import time
+import struct
+import numpy as np
+
+import drParse
+
+MAGIC		= "GALILDR1"
+prefix		= struct.Struct("<dH")
+indexDtype	= np.dtype([("t", "<f8"), ("offset", "<u8")])
+
+class DRLogWriter:
+
+	def __init__(self, path = "posvelDR.drlog", indexEvery = 1.0, flushEvery = 1.0, flushRecords = 1000):
+		self.path = path
+		self.indexEvery = indexEvery
+		self.flushEvery = flushEvery
+		self.flushRecords = flushRecords
+
+		self.fp = open(path, "ab")
+		self.offset = self.fp.tell()
+		if self.offset == 0:
+			self.fp.write(MAGIC)
+			self.offset = len(MAGIC)
+
+		self.idxFp = open(path + ".idx", "ab")
+		self.lastIndexed = 0
+		self.lastFlushed = time.time()
+		self.unflushed = 0
+
+	def write(self, dat, recvTime = None):
+		if recvTime is None:
+			recvTime = time.time()
+
+		if recvTime - self.lastIndexed >= self.indexEvery:
+			self.idxFp.write(struct.pack("<dQ", recvTime, self.offset))
+			self.lastIndexed = recvTime
+
+		self.fp.write(prefix.pack(recvTime, len(dat)) + dat)
+		self.offset += prefix.size + len(dat)
+
+		self.unflushed += 1
+		if self.unflushed >= self.flushRecords or recvTime - self.lastFlushed >= self.flushEvery:
+			self.flush()
+			self.lastFlushed = recvTime
+
+	def flush(self):
+		self.fp.flush()
+		self.idxFp.flush()
+		self.unflushed = 0
+
+	def close(self):
+		self.fp.close()
+		self.idxFp.close()
+
+
+class DRLogReader:
+
+	def __init__(self, path = "posvelDR.drlog"):
+		self.path = path
+		self.fp = open(path, "rb")
+		if self.fp.read(len(MAGIC)) != MAGIC:
+			raise ValueError, "%s is not a data record log" % path
+		self.index = self.loadIndex()
+		self.skipped = 0		# datagrams batches() could not parse
+
+	def loadIndex(self):
+		index = np.zeros(0, dtype=indexDtype)
+		if os.path.exists(self.path + ".idx"):
+			index = np.fromfile(self.path + ".idx", dtype=indexDtype)
+
+		# Rebuild (or finish) the index by scanning whatever it does not cover
+		start = len(MAGIC)
+		if len(index):
+			start = int(index["offset"][-1])
+		extra = []
+		lastIndexed = 0
+		for t, offset, dat in self.scan(start):
+			if t - lastIndexed >= 1.0:
+				extra.append((t, offset))
+				lastIndexed = t
+		if extra:
+			index = np.concatenate((index, np.array(extra, dtype=indexDtype)))
+		return index
+
+	def scan(self, offset):
+		# yields (receive time, offset, datagram) from offset to the end of the log
+		self.fp.seek(offset)
+		while True:
+			head = self.fp.read(prefix.size)
+			if len(head) < prefix.size:
+				return
+			t, length = prefix.unpack(head)
+			dat = self.fp.read(length)
+			if len(dat) < length:			# truncated last record
+				return
+			yield t, offset, dat
+			offset += prefix.size + length
+
+	def seek(self, t):
+		# byte offset of an indexed record at or before time t
+		i = np.searchsorted(self.index["t"], t, side = "right") - 1
+		if i < 0:
+			return len(MAGIC)
+		return int(self.index["offset"][i])
+
+	def records(self, start = None, stop = None):
+		# yields (receive time, datagram) for every record received between start and stop (seconds since the epoch)
+		offset = len(MAGIC) if start is None else self.seek(start)
+		for t, offset, dat in self.scan(offset):
+			if start is not None and t < start:
+				continue
+			if stop is not None and t >= stop:
+				return
+			yield t, dat
+
+	def batches(self, start = None, stop = None, size = 10000):
+		# yields (receive times, record array) in batches of up to size records.
+		# Consecutive records with the same layout are parsed together with drParse.parseDataRecords,
+		# a batch ends early when the layout changes. Records that do not parse are skipped (and counted in skipped).
+		times = []
+		dats = []
+		key = None
+		for t, dat in self.records(start, stop):
+			if len(dat) < 4:
+				continue
+			if (dat[:4] != key) or (len(dats) >= size):
+				for batch in self.__parseBatch(times, dats):
+					yield batch
+				times, dats, key = [], [], dat[:4]		# flags and length, the layout of the record
+			times.append(t)
+			dats.append(dat)
+		for batch in self.__parseBatch(times, dats):
+			yield batch
+
+	def __parseBatch(self, times, dats):
+		if not dats:
+			return
+		try:
+			records = drParse.parseDataRecords("".join(dats))
+		except ValueError:
+			# a bad datagram in the batch, parse them one at a time to find it and keep the rest
+			good = []
+			for t, dat in zip(times, dats):
+				try:
+					drParse.parseDataRecords(dat)
+				except ValueError:
+					self.skipped += 1
+					continue
+				good.append((t, dat))
+			if not good:
+				return
+			times = [t for t, dat in good]
+			records = drParse.parseDataRecords("".join(dat for t, dat in good))
+		yield np.array(times), records
+
+	def close(self):
+		self.fp.close()
@@ -144,6 +144,8 @@ SW	h axis analog					H block
 '''
 
 import struct
+import collections
+import numpy as np
 
 iBlkParseStr 	= "<HBBBBBBBBBBBBBBBBBBBBBB"
 iBlkSize 		= struct.calcsize(iBlkParseStr)
@@ -154,7 +156,11 @@ stBlkSize 		= struct.calcsize(stBlkParseStr)
 axBlkParseStr	= "<HBBlllllhh"
 axBlkSize 		= struct.calcsize(axBlkParseStr)
 
-def bitflip(intIn):		# HHHHHAAAAAAAACCCCCCCCCKKKKKKKKK!!!!(pocalypse)
+iBlkFields		= ("SN", "GI0", "GI1", "GI2", "GI3", "GI4", "GI5", "GI6", "GI7", "GI8", "GI9",
+					"GO0", "GO1", "GO2", "GO3", "GO4", "GO5", "GO6", "GO7", "GO8", "GO9", "EC", "GS")
+axBlkFields		= ("status", "switches", "stopCode", "refPos", "motorPos", "posError", "auxPos", "vel", "torque", "analog")
+
+def _bitflipSlow(intIn):		# HHHHHAAAAAAAACCCCCCCCCKKKKKKKKK!!!!(pocalypse)
 								#Swaps MSB With LSB, MSB-1 with LSB+1, etc..
 								#Basically goes from MSB to LSB order
 	out = 0
@@ -177,6 +183,13 @@ def bitflip(intIn):		# HHHHHAAAAAAAACCCCCCCCCKKKKKKKKK!!!!(pocalypse)
 		out = out + 128
 	return out
 
+# Every possible byte, reversed. Built once with the branchy version above.
+bitflipTable	= tuple(_bitflipSlow(x) for x in range(256))
+bitflipArray	= np.array(bitflipTable, dtype=np.uint8)		# index with an array of bytes to flip them all at once
+
+def bitflip(intIn):
+	return bitflipTable[intIn]
+
 
 def _BV(inVal):
 	return 1<<inVal
@@ -207,12 +220,159 @@ def parseAxisBlock(axBlkStr):
 	return ret
 
 
+stateFields = dict(I = ("SN",), axis = ("status", "motorPos", "vel"))		# what DataRecord.state() reads
+
+def skipFields(parseStr, fields, keep):
+	# parseStr (one code per field, no byte order) with the fields not in keep turned into pad bytes
+	return "".join(code if name in keep else "%dx" % struct.calcsize("<" + code) for code, name in zip(parseStr, fields))
+
+def compileLayout(flags):
+	# Build the parser for all records with the given (byte swapped) flags.
+	# The set of blocks in a record only changes when the DR configuration does, so
+	# instead of walking the flags for every packet we build one struct.Struct covering
+	# the header and every block present, plus where each block's values land in the
+	# unpacked tuple.
+	#
+	# returns (struct.Struct, [(block name, field names, start, stop), ...], {block name: byte offset},
+	#	{block names: compileState(layout, block names)}, filled in as DataRecord.state() needs them)
+
+	parseStr = "<HH"	# header: flags and length
+	blocks = []
+	offsets = dict()
+	pos = 2
+
+	# Blocks transmitted in the order:
+	# I S T A B C D E F G H
+	if flags & _BV(10):		# I Block (General Status and IO) is present
+		blocks.append(("I", iBlkFields, pos, pos+len(iBlkFields)))
+		offsets["I"] = struct.calcsize(parseStr)
+		parseStr += iBlkParseStr[1:]
+		pos += len(iBlkFields)
+
+	for bit in (8, 9):		# S and T Blocks (segmented moves in the S and T planes). Skipped, like before
+		if flags & _BV(bit):
+			parseStr += stBlkParseStr[1:]
+			pos += len(stBlkParseStr)-1
+
+	for axis in range(8):	# A - H Blocks (Axis status blocks)
+		if flags & _BV(axis):
+			blocks.append((chr(65+axis), axBlkFields, pos, pos+len(axBlkFields)))
+			offsets[chr(65+axis)] = struct.calcsize(parseStr)
+			parseStr += axBlkParseStr[1:]
+			pos += len(axBlkFields)
+
+	return struct.Struct(parseStr), blocks, offsets, dict()
+
+def compileState(layout, names):
+	# A narrow struct.Struct for records with layout, that only reads stateFields (the sample
+	# number, and the status, position and velocity of an axis) of the blocks in names, and
+	# skips everything else.
+	#
+	# returns (struct.Struct, {block name: index of its first value in what the struct unpacks})
+
+	stateStr = "<"
+	index = dict()
+	pos = 0
+	n = 0
+	for name, fields, start, stop in layout[1]:
+		if name not in names:
+			continue
+		if name == "I":
+			parseStr, keep = iBlkParseStr, stateFields["I"]
+		else:
+			parseStr, keep = axBlkParseStr, stateFields["axis"]
+		offset = layout[2][name]
+		if offset > pos:
+			stateStr += "%dx" % (offset - pos)
+		stateStr += skipFields(parseStr[1:], fields, keep)
+		pos = offset + struct.calcsize(parseStr)
+		index[name] = n
+		n += len(keep)
+	return struct.Struct(stateStr), index
+
+layoutCache = dict()		# flags -> compileLayout(flags)
+
+iBlkStruct		= struct.Struct(iBlkParseStr)
+axBlkStruct		= struct.Struct(axBlkParseStr)
+
+class IBlock(collections.namedtuple("IBlock", iBlkFields)):
+	# General status and IO, as a tuple with attribute access (rec.I.SN, rec.I.GI4, ...)
+	__slots__ = ()
+
+	# GI8 is reversed in the hardware. The tuple keeps the byte as received, the
+	# attribute flips it back to make it valid
+	GI8 = property(lambda self: bitflipTable[tuple.__getitem__(self, 9)])
+
+class AxisBlock(collections.namedtuple("AxisBlock", axBlkFields)):
+	# Axis status, as a tuple with attribute access (rec.A.motorPos, rec.A.vel, ...)
+	__slots__ = ()
+
+class DataRecord(object):
+	# One data record. Blocks are attributes named like the dicts the parser used to return
+	# ("I", "A" - "H"), and are only decoded (straight from the packet, one unpack_from
+	# each) the first time they are accessed. rec["A"] works too.
+	__slots__ = ("flags", "raw", "layout", "I", "A", "B", "C", "D", "E", "F", "G", "H")
+
+	def __init__(self, flags, raw, layout):
+		self.flags = flags
+		self.raw = raw
+		self.layout = layout
+
+	def __getattr__(self, name):		# only called for blocks that have not been decoded yet
+		try:
+			offset = self.layout[2][name]
+		except KeyError:
+			raise AttributeError, "Data record has no %s block" % name
+		if name == "I":
+			block = IBlock._make(iBlkStruct.unpack_from(self.raw, offset))
+		else:
+			block = AxisBlock._make(axBlkStruct.unpack_from(self.raw, offset))
+		setattr(self, name, block)
+		return block
+
+	def __getitem__(self, name):
+		return getattr(self, name)
+
+	def __contains__(self, name):
+		return name in self.layout[2]
+
+	def blocks(self):
+		# names of the blocks in this record, in transmission order
+		return [name for name, fields, start, stop in self.layout[1]]
+
+	def __state(self, names):
+		try:
+			return self.layout[3][names]
+		except KeyError:
+			ret = self.layout[3][names] = compileState(self.layout, names)
+			return ret
+
+	def state(self, names = "IABCDEFGH"):
+		# stateFields of the blocks in names, as one flat tuple, without decoding anything else:
+		# (SN, A status, A motorPos, A vel, B status, ...) for those of them the record has.
+		# stateIndex() says where each block starts
+		return self.__state(names)[0].unpack_from(self.raw)
+
+	def stateIndex(self, name, names = "IABCDEFGH"):
+		# where block name's values start in state(names), None if they do not include it
+		return self.__state(names)[1].get(name)
+
+	def toDict(self):
+		# everything decoded at once, as a dict of dicts
+		values = self.layout[0].unpack_from(self.raw)
+		ret = dict()
+		for name, fields, start, stop in self.layout[1]:
+			ret[name] = dict(zip(fields, values[start:stop]))
+		if "I" in ret:
+			ret["I"]["GI8"] = bitflip(ret["I"]["GI8"])
+		return ret
+
 def parseDataRecord(drString):
 	if len(drString) < 4:
 		print "Invalid data record"
 		return 
 
-	flags, drLen = struct.unpack("<HH", drString[:4])
+	flags, drLen = struct.unpack_from("<HH", drString)
 	if len(drString) != drLen:
 		print "Invalid DR length"
 		return
@@ -221,58 +381,211 @@ def parseDataRecord(drString):
 	# Byte swap the flags (cause it's sent big-endian?) This doesn't match the docs, but it seem to match what I'm actually receiving.
 	# Done with integer math because fuck you
 
-	offsetInDat = 4		# first 4 bytes are the length and flags 
+	try:
+		layout = layoutCache[flags]
+	except KeyError:
+		layout = layoutCache[flags] = compileLayout(flags)
 
-	# Blocks transmitted in the order:
-	# I S T A B C D E F G H
-	ret = dict()
-	if flags & _BV(10):		# I Block (General Status and IO) is present
-
-		ret["I"] = parseIBlock(drString[offsetInDat:(offsetInDat+iBlkSize)])
-		offsetInDat += iBlkSize
-		pass
-
-	if flags & _BV(8): 		# S Block (segmented moves in S-plane)
-		offsetInDat += stBlkSize
-		pass
-	if flags & _BV(9): 		# T Block (segmented moves in T-plane)
-		offsetInDat += stBlkSize
-		pass
-
-
-	if flags & _BV(0): 		# A Block (Axis A status block) is present
-		ret["A"] = parseAxisBlock(drString[offsetInDat:(offsetInDat+axBlkSize)])
-		offsetInDat += axBlkSize
-
-	if flags & _BV(1): 		# B Block (Axis B status block) is present
-		ret["B"] = parseAxisBlock(drString[offsetInDat:(offsetInDat+axBlkSize)])
-		offsetInDat += axBlkSize
-
-	if flags & _BV(2): 		# C Block (Axis C status block) is present
-		ret["C"] = parseAxisBlock(drString[offsetInDat:(offsetInDat+axBlkSize)])
-		offsetInDat += axBlkSize
-
-	if flags & _BV(3): 		# D Block (Axis D status block) is present
-		ret["D"] = parseAxisBlock(drString[offsetInDat:(offsetInDat+axBlkSize)])
-		offsetInDat += axBlkSize
-
-	if flags & _BV(4): 		# E Block (Axis E status block) is present
-		ret["E"] = parseAxisBlock(drString[offsetInDat:(offsetInDat+axBlkSize)])
-		offsetInDat += axBlkSize
-
-	if flags & _BV(5): 		# F Block (Axis F status block) is present
-		ret["F"] = parseAxisBlock(drString[offsetInDat:(offsetInDat+axBlkSize)])
-		offsetInDat += axBlkSize
-
-	if flags & _BV(6): 		# G Block (Axis G status block) is present
-		ret["G"] = parseAxisBlock(drString[offsetInDat:(offsetInDat+axBlkSize)])
-		offsetInDat += axBlkSize
-
-	if flags & _BV(7): 		# H Block (Axis H status block) is present
-		ret["H"] = parseAxisBlock(drString[offsetInDat:(offsetInDat+axBlkSize)])
-		offsetInDat += axBlkSize
+	if drLen < layout[0].size:
+		print "Invalid DR length"
+		return
 
-	return ret
+	return DataRecord(flags, drString, layout)
+
+
+class SampleStats:
+	# Loss and ordering statistics of a data record stream, from the sample numbers (I block SN).
+	#
+	# The galil sends a record every `interval` servo samples (the n of "DR n,h"), so the SN
+	# steps by interval from one record to the next, wrapping at 2**16. If interval is not
+	# given it is taken to be the smallest step seen so far.
+	#
+	#	received	records seen
+	#	gaps		times the SN jumped forward by more than one interval
+	#	lost		records missing in those jumps (less the ones that turned up late)
+	#	duplicates	records with an SN seen within the last `window` records
+	#	reordered	records that arrived after a later one
+	#	jitter		running mean deviation of the arrival time from the servo clock, in seconds
+	#				(same estimator as RTP, RFC 3550)
+	#	period		estimated seconds per servo sample, from the arrival times
+	#	maxArrivalGap	longest time between two records, in seconds
+
+	def __init__(self, interval = None, window = 64):
+		self.interval = interval
+		self.learnInterval = interval is None
+		self.recent = collections.deque(maxlen = window)
+		self.reset()
+
+	def reset(self):
+		self.received = 0
+		self.gaps = 0
+		self.lost = 0
+		self.duplicates = 0
+		self.reordered = 0
+		self.jitter = 0.0
+		self.period = None
+		self.maxArrivalGap = 0.0
+		self.lastSN = None
+		self.lastArrival = None
+		self.recent.clear()
+
+	def update(self, sn, arrival):
+		# account for one record with sample number sn, received at time arrival (seconds).
+		# Returns True if it is the newest record so far, False for duplicates and late ones.
+		self.received += 1
+		if sn in self.recent:
+			self.duplicates += 1
+			return False
+		self.recent.append(sn)
+
+		if self.lastSN is None:
+			self.lastSN, self.lastArrival = sn, arrival
+			return True
+
+		step = (sn - self.lastSN) % 2**16
+		if step >= 2**15:					# behind the newest record, it was overtaken
+			self.reordered += 1
+			if self.lost:
+				self.lost -= 1			# and was counted lost when the later one came in
+			return False
+
+		if self.learnInterval and (self.interval is None or step < self.interval):
+			self.interval = step
+
+		if step > self.interval:
+			self.gaps += 1
+			self.lost += step / self.interval - 1
+
+		arrivalGap = arrival - self.lastArrival
+		self.maxArrivalGap = max(self.maxArrivalGap, arrivalGap)
+		if self.period is None:
+			self.period = arrivalGap / step
+		else:
+			d = arrivalGap - self.period * step
+			self.jitter += (abs(d) - self.jitter) / 16.
+			self.period += (arrivalGap / step - self.period) / 256.
+
+		self.lastSN, self.lastArrival = sn, arrival
+		return True
+
+	def snapshot(self):
+		# the counters as a dict, for logging and display
+		return dict(received = self.received, gaps = self.gaps, lost = self.lost, duplicates = self.duplicates,
+				reordered = self.reordered, jitter = self.jitter, period = self.period,
+				maxArrivalGap = self.maxArrivalGap, interval = self.interval)
+
+	def __str__(self):
+		s = self.snapshot()
+		return "DR stats: %(received)d received, %(lost)d lost in %(gaps)d gaps, %(duplicates)d duplicates, " \
+			"%(reordered)d reordered, %(interval)s samples per record" % s + \
+			", jitter %.2f ms" % (s["jitter"] * 1000)
+
+
+# NumPy equivalents of the blocks, for decoding many records at once.
+# Same layout as the struct strings above, little-endian and unpadded.
+iBlkDtype	= np.dtype([(name, "<u2" if name == "SN" else "u1") for name in iBlkFields])
+stBlkDtype	= np.dtype([("segCount", "<u2"), ("moveStatus", "<u2"), ("distance", "<i4")])
+axBlkDtype	= np.dtype([(name, fmt) for name, fmt in zip(axBlkFields, ("<u2", "u1", "u1", "<i4", "<i4", "<i4", "<i4", "<i4", "<i2", "<i2"))])
+
+def recordDtype(flags):
+	# Structured dtype of a whole data record with the given (byte swapped) flags.
+	# Each block is a nested field named like the dicts parseDataRecord returns
+	# ("I", "S", "T", "A" - "H"), so records["A"]["motorPos"] is the A axis motor position.
+	fields = [("flags", "<u2"), ("length", "<u2")]
+	if flags & _BV(10):
+		fields.append(("I", iBlkDtype))
+	if flags & _BV(8):
+		fields.append(("S", stBlkDtype))
+	if flags & _BV(9):
+		fields.append(("T", stBlkDtype))
+	for axis in range(8):
+		if flags & _BV(axis):
+			fields.append((chr(65+axis), axBlkDtype))
+	return np.dtype(fields)
+
+dtypeCache = dict()		# flags -> recordDtype(flags)
+
+def parseDataRecords(buf):
+	# Decode a buffer of back to back data records that all have the same layout (e.g.
+	# read from a capture file, or a batch of received packets) into a NumPy record
+	# array, without a python loop per record. The array is a view of buf, nothing is copied.
+	#
+	# Unlike parseDataRecord, GI8 is left as transmitted (bit reversed).
+	#
+	# Raises ValueError if the records do not all match the layout of the first one.
+
+	if len(buf) < 4:
+		return np.zeros(0, dtype=recordDtype(0)).view(np.recarray)
+
+	flags, drLen = struct.unpack_from("<HH", buf)
+	flags = (flags / 2**8) + ((flags % 2**8) * 2**8)		# byte swap, see parseDataRecord
+	try:
+		dtype = dtypeCache[flags]
+	except KeyError:
+		dtype = dtypeCache[flags] = recordDtype(flags)
+
+	if drLen != dtype.itemsize or len(buf) % dtype.itemsize:
+		raise ValueError, "Data records do not match the layout of the first record"
+
+	records = np.frombuffer(buf, dtype=dtype)
+	if (records["length"] != drLen).any() or (records["flags"] != records["flags"][0]).any():
+		raise ValueError, "Data records do not all have the same layout"
+	return records.view(np.recarray)
+
+
+# The GPS time stamps are the millisecond time of week, masked to 29 bits. A week is longer
+# than 2**29 ms, so the masked value wraps to 0 once partway through the week (after ~6.2 days),
+# and then again at the week rollover, where it drops back by TOW_WEEK_WRAP.
+TOW_MASK		= 0x1FFFFFFF
+MS_PER_WEEK		= 7*24*3600*1000
+TOW_WEEK_WRAP	= MS_PER_WEEK - (TOW_MASK+1)		# 67929088, the drop at the week rollover
+
+def gpsTimestamp(gi4, gi5, gi9, gi8):
+	# Assemble the 1PPS time stamp (masked ms time of week) from the I block bytes.
+	# gi8 must already be bit flipped (as parseDataRecord returns it, or bitflipArray[raw]).
+	# Works on python ints, or on arrays of bytes from parseDataRecords.
+	if isinstance(gi4, np.ndarray):
+		gi4, gi5, gi9, gi8 = [np.asarray(x, dtype=np.int64) for x in (gi4, gi5, gi9, gi8)]
+	return ((gi8 & 0x1F) << 24) | (gi9 << 16) | (gi5 << 8) | gi4
+
+def recordTimestamps(records):
+	# time stamps of every record in a parseDataRecords array
+	return gpsTimestamp(records["I"]["GI4"], records["I"]["GI5"], records["I"]["GI9"], bitflipArray[records["I"]["GI8"]])
+
+def towDelta(a, b):
+	# a - b for two masked time of week values, which are assumed to be close together
+	# (well under 2**25 ms, ~9 hours), corrected for the 29 bit wrap and the week rollover
+	# if one happened between them. Scalars or arrays.
+	d = a - b
+	if isinstance(d, np.ndarray):
+		mag = np.abs(d)
+		d = d - np.sign(d)*np.where(mag > 2**28, TOW_MASK+1, np.where(mag > 2**25, TOW_WEEK_WRAP, 0))
+		return d
+	if d > 2**28:
+		return d - (TOW_MASK+1)
+	if d < -2**28:
+		return d + (TOW_MASK+1)
+	if d > 2**25:
+		return d - TOW_WEEK_WRAP
+	if d < -2**25:
+		return d + TOW_WEEK_WRAP
+	return d
+
+def unwrapTimestamps(ts):
+	# Turn a sequence of masked time stamps into a continuous millisecond count, undoing
+	# the 29 bit wraps and week rollovers. Small steps back (glitches) are left alone.
+	ts = np.asarray(ts, dtype=np.int64)
+	if not len(ts):
+		return ts
+	steps = np.zeros(len(ts), dtype=np.int64)
+	steps[1:] = towDelta(ts[1:], ts[:-1]) - (ts[1:] - ts[:-1])		# what each step is missing
+	return ts + np.cumsum(steps)
+
+
+def towFromTime(t):
+	# masked ms time of week of unix time t (scalar or array), the same clock as getMsTOWwMasking.
+	# The week starts on Sunday, 1970-01-01 was a Thursday
+	return (np.asarray((np.asarray(t) - 3*24*3600) % (MS_PER_WEEK/1000) * 1000).astype(np.int64) & TOW_MASK)
 
 
 import datetime
@@ -10,9 +10,16 @@ class create_connection:
 	def settimeout(self, timeout):
 		pass
 
+	def gettimeout(self):
+		return None
+
 	def recv(self, bytes):
 		return ":"
 
+	def recv_into(self, buf, nbytes = 0):
+		buf[0] = ":"
+		return 1
+
 
 	def sendall(self, data):
 		pass
@@ -24,10 +31,10 @@ class create_connection:
 				print("it had arguments: " + str(args))
 
 class timeout(StandardError):
-	def __init__(self, errno, address):
+	def __init__(self, *args):
 		pass
 
 
 class error(StandardError):
-	def __init__(self, errno, address):
+	def __init__(self, *args):
 		pass
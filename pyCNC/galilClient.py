@@ -0,0 +1,497 @@
+'''
+
+Event driven Galil client: one thread, one select() loop, for the command socket, the
+unsolicited message socket and the UDP data record socket.
+
+GalilInterface blocks on each socket in its own thread, with a 0.5 s timeout so the threads
+notice when to stop. Here every socket is non-blocking and serviced by the same loop, which
+sleeps in select() until one of them has data (or a request is queued from another thread),
+so nothing waits on a timeout and close() returns straight away.
+
+	client = GalilClient("192.168.1.241")
+	client.connect(unsol = True, records = True)
+
+	pos = client.query("TP").result()		# query() returns a Future
+	futures = [client.query("TV%s" % axis) for axis in "AB"]
+	vel = [f.result() for f in futures]		# both requests go out before either reply is read
+
+	for message in client.messages():		# unsolicited messages (MG from the galil code)
+		...
+	for recvTime, record in client.records():	# data records, drParse.DataRecord
+		...
+
+	client.close()
+
+Replies are matched to requests in the order they were sent, the galil answers every command
+in order. Nothing in a reply says which command it answers, so once one goes missing (or an
+extra one turns up) that order is lost. When a request times out it is failed and taken off
+the pending queue, and the client reconnects: everything still pending on the old connection
+fails too (socket.error), and the new connection starts in step. reconnect() does the same on
+demand.
+
+This is the python 2 version of an asyncio client: the loop thread plays the event loop, and
+Future.result() is the await.
+
+'''
+
+import time
+import Queue
+import select
+import socket
+import threading
+import collections
+
+import drParse
+from galilInterface import SocketReader, commandName, splitCommands, packLines, CONF_TIMEOUT, DR_INTERVAL
+
+UDP_PORT = 5005
+
+
+class Future:
+	# The result of a request, set by the loop thread. result() waits for it.
+
+	def __init__(self, cmdStr = None):
+		self.cmdStr = cmdStr
+		self.event = threading.Event()
+		self.value = None
+		self.error = None
+		self.callbacks = []
+
+	def done(self):
+		return self.event.is_set()
+
+	def setResult(self, value):
+		if not self.done():
+			self.value = value
+			self.__finish()
+
+	def setError(self, error):
+		if not self.done():
+			self.error = error
+			self.__finish()
+
+	def __finish(self):
+		self.event.set()
+		for callback in self.callbacks:
+			callback(self)
+
+	def addCallback(self, callback):
+		# callback(future) once it is done, from the loop thread (or now, if it already is)
+		if self.done():
+			callback(self)
+		else:
+			self.callbacks.append(callback)
+
+	def result(self, timeout = None):
+		# the reply, raising whatever the request failed with
+		if not self.event.wait(timeout):
+			raise socket.timeout, "No reply to %s" % self.cmdStr
+		if self.error:
+			raise self.error
+		return self.value
+
+
+class Stream:
+	# Items from the loop thread (messages, data records) for whoever is reading them.
+	# When the reader falls behind by more than maxsize, the oldest are dropped.
+
+	def __init__(self, maxsize = 10000):
+		self.queue = Queue.Queue(maxsize)
+		self.dropped = 0
+
+	def put(self, item):
+		while True:
+			try:
+				self.queue.put_nowait(item)
+				return
+			except Queue.Full:
+				try:
+					self.queue.get_nowait()
+					self.dropped += 1
+				except Queue.Empty:
+					pass
+
+	def get(self, timeout = None):
+		# the next item, or None after timeout seconds
+		try:
+			return self.queue.get(True, timeout)
+		except Queue.Empty:
+			return None
+
+	def __iter__(self):
+		# every item, until the client closes (a None is put in the stream)
+		while True:
+			item = self.queue.get()
+			if item is None:
+				return
+			yield item
+
+
+class GalilClient:
+
+	def __init__(self, ip, port = 23, timeout = CONF_TIMEOUT):
+		self.ip = ip
+		self.port = port
+		self.timeout = timeout
+
+		self.running = False
+		self.thread = None
+		self.loopError = None		# what stopped the loop thread, once it has
+
+		self.con = None
+		self.unsolCon = None
+		self.drSock = None
+
+		self.lock = threading.Lock()		# outgoing and pending, shared with the callers' threads
+		self.outgoing = []			# command lines waiting for the socket to be writable
+		self.pending = collections.deque()	# [future, time sent, deadline] per command, in the order sent
+		self.udpPending = collections.deque()	# same for the commands sent over UDP
+		self.udpText = ""
+
+		self.unsolStream = Stream()
+		self.recordStream = Stream()
+		self.drStats = None
+		self.latency = {}			# same as GalilInterface.latency
+		self.reconnects = 0
+		self.reconnectWanted = False
+
+		# Other threads wake the loop up by sending a byte to this socket. A UDP socket
+		# rather than a pipe, so it works with select() on windows too.
+		self.wakeSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.wakeSock.bind(("127.0.0.1", 0))
+		self.wakeSock.setblocking(0)
+
+	def connect(self, unsol = True, records = False):
+		self.con = socket.create_connection((self.ip, self.port), self.timeout)
+		self.con.setblocking(0)
+		self.reader = SocketReader(self.con)
+
+		self.running = True
+		self.loopError = None
+		self.thread = threading.Thread(target = self.__loop, name = "galilClientLoop")
+		self.thread.daemon = True
+		self.thread.start()
+
+		if unsol:
+			self.__openUnsol()
+		if records:
+			self.startRecords()
+
+	def reconnect(self):
+		# Open a new command connection (from the loop thread), failing whatever is pending
+		with self.lock:
+			self.reconnectWanted = True
+		self.__wake()
+
+	def __openUnsol(self):
+		# Unsolicited messages on a second socket, as in GalilInterface
+		con = socket.create_connection((self.ip, self.port+1), self.timeout)
+		con.settimeout(self.timeout)
+		unsolReader = SocketReader(con)
+		for cmd in ("CF I;", "CW 2;"):		# see GalilInterface.__initUnsolicitedMessageSocket
+			con.sendall(cmd + "\r\n")
+			unsolReader.readUntil((":", "?"), time.time() + self.timeout)
+		con.setblocking(0)
+		with self.lock:
+			self.unsolReader = unsolReader
+			self.unsolCon = con
+		self.__wake()
+
+	def startRecords(self, interval = DR_INTERVAL):
+		# Open the UDP socket and have the galil send data records to it every interval samples
+		probe = socket.create_connection((self.ip, self.port), self.timeout)	# which local interface talks to the galil
+		localIP = probe.getsockname()[0]
+		probe.close()
+
+		drSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+		drSock.bind((localIP, UDP_PORT))
+		drSock.setblocking(0)
+		self.drAddr = (self.ip, UDP_PORT)
+		self.drStats = drParse.SampleStats(interval)
+		with self.lock:
+			self.drSock = drSock
+		self.__wake()
+
+		handle = None
+		for attempt in range(5):		# the first reply on a new UDP socket is sometimes garbage
+			try:
+				handle = self.queryUDP("WH").result(self.timeout)
+			except socket.timeout:
+				continue
+			if "IH" in handle:
+				break
+		if not handle or "IH" not in handle:
+			raise ValueError, "No handle number from the galil over UDP"
+		self.udpHandleNumber = ord(handle.strip()[-1])-65
+		self.queryUDP("DR %d,%d" % (interval, self.udpHandleNumber))
+
+	def stopRecords(self):
+		if self.drSock:
+			try:
+				self.queryUDP("DR 0,0").result(self.timeout)
+				self.queryUDP("IHS=-3").result(self.timeout)	# close the galil's end of the UDP handle
+			except socket.timeout:
+				pass
+
+	# Requests. All of these can be called from any thread.
+
+	def query(self, cmdStr, timeout = None):
+		# Send a command, returns a Future of the reply (stripped like GalilInterface.sendAndRecieve's)
+		return self.__send([cmdStr], timeout)[0]
+
+	def queryBatch(self, commands, timeout = None):
+		# Send several commands in one write (see GalilInterface.sendBatch), a Future per command
+		return self.__send(commands, timeout)
+
+	def queryUDP(self, cmdStr, timeout = None):
+		# a command over the UDP socket (the data records start, stop and handle commands)
+		future = Future(cmdStr)
+		deadline = time.time() + (timeout or self.timeout)
+		with self.lock:
+			if not self.running:
+				raise self.loopError or socket.error("Galil client is not connected")
+			self.udpPending.append([future, time.time(), deadline])
+			self.drSock.sendto(cmdStr + "\r\n", self.drAddr)
+		self.__wake()
+		return future
+
+	def __send(self, commands, timeout):
+		commands = splitCommands(commands)
+		deadline = time.time() + (timeout or self.timeout)
+		futures = [Future(cmd) for cmd in commands]
+		with self.lock:
+			if not self.running:		# (while reconnecting, con is None and the commands wait in outgoing)
+				raise self.loopError or socket.error("Galil client is not connected")
+			now = time.time()
+			for future in futures:
+				self.pending.append([future, now, deadline])
+			self.outgoing.extend(line + "\r" for line in packLines(commands))
+		self.__wake()
+		return futures
+
+	def messages(self):
+		# unsolicited messages, see Stream
+		return self.unsolStream
+
+	def records(self):
+		# (receive time, drParse.DataRecord) of every data record, see Stream
+		return self.recordStream
+
+	def latencies(self):
+		return dict((cmd, (count, total/count, worst, last)) for cmd, (count, total, worst, last) in self.latency.items())
+
+	def __wake(self):
+		self.wakeSock.sendto("w", self.wakeSock.getsockname())
+
+	# The loop thread
+
+	def __loop(self):
+		# If the loop stops for any reason (close(), or an exception: a select error, or one
+		# from a callback), every request still waiting is failed, so no result() waits forever
+		error = socket.error("Galil client closed")
+		try:
+			self.__run()
+		except Exception, e:
+			error = e
+			raise
+		finally:
+			with self.lock:
+				self.running = False
+				self.loopError = error
+				lost = [entry[0] for entry in self.pending] + [entry[0] for entry in self.udpPending]
+				self.pending.clear()
+				self.udpPending.clear()
+				self.outgoing = []
+			for future in lost:
+				future.setError(error)
+			self.unsolStream.put(None)
+			self.recordStream.put(None)
+
+	def __run(self):
+		while self.running:
+			with self.lock:
+				readable = [s for s in (self.wakeSock, self.con, self.unsolCon, self.drSock) if s]
+				writable = [self.con] if self.outgoing and self.con else []
+				deadlines = [entry[2] for entry in self.pending if not entry[0].done()] + \
+						[entry[2] for entry in self.udpPending if not entry[0].done()]
+			wait = max(0, min(deadlines) - time.time()) if deadlines else None
+
+			try:
+				r, w, x = select.select(readable, writable, [], wait)
+			except (select.error, socket.error):
+				if not self.running:
+					break
+				raise
+
+			if self.wakeSock in r:
+				self.__drain(self.wakeSock)
+			if w:
+				self.__write()
+			if self.con and self.con in r:
+				self.__readReplies()
+			if self.unsolCon and self.unsolCon in r:
+				self.__readUnsol()
+			if self.drSock and self.drSock in r:
+				self.__readUDP()
+			self.__expire()
+			if self.reconnectWanted:
+				self.__reconnect("Reconnected, the galil's reply was not read")
+
+	def __drain(self, sock):
+		try:
+			while sock.recv(64):
+				pass
+		except socket.error:
+			pass
+
+	def __write(self):
+		with self.lock:
+			data = "".join(self.outgoing)
+			self.outgoing = []
+		try:
+			sent = self.con.send(data)
+		except socket.error:
+			self.__connectionLost()
+			return
+		if sent < len(data):
+			with self.lock:
+				self.outgoing.insert(0, data[sent:])
+
+	def __readReplies(self):
+		try:
+			self.reader.fill()
+		except socket.error:		# readable but nothing to read, the galil closed the connection
+			self.__connectionLost()
+			return
+		while True:
+			i, term = self.reader.find((":", "?"))
+			if i < 0:
+				return
+			retString = self.reader.take(i + 1)
+			with self.lock:
+				if not self.pending:
+					continue			# an acknowledgement nobody is waiting for
+				future, sent, deadline = self.pending.popleft()
+			self.__record(future.cmdStr, sent)
+			if term == "?":
+				self.__reject(future)
+			else:
+				future.setResult(retString.rstrip("\r\n:").strip().strip(":"))
+
+	def __connectionLost(self):
+		self.__reconnect("Connection to the galil lost")
+
+	def __reconnect(self, reason):
+		# Fail everything pending on the command connection, and open a new one. If that
+		# does not work the client stays disconnected: requests wait in outgoing, time out,
+		# and the timeout tries to reconnect again.
+		with self.lock:
+			lost = [entry[0] for entry in self.pending]
+			self.pending.clear()
+			self.outgoing = []
+			self.reconnectWanted = False
+			con, self.con = self.con, None
+		for future in lost:
+			future.setError(socket.error(reason))
+		if con:
+			try:
+				con.close()
+			except socket.error:
+				pass
+
+		try:
+			con = socket.create_connection((self.ip, self.port), self.timeout)
+		except socket.error:
+			return
+		con.setblocking(0)
+		with self.lock:
+			self.reader = SocketReader(con)
+			self.con = con
+		self.reconnects += 1
+
+	def __reject(self, future):
+		# fail the request with the galil's error message, which takes another round trip
+		def setError(tc1):
+			message = tc1.error and "?" or tc1.value
+			future.setError(ValueError("Galil rejected %s: %s" % (future.cmdStr, message)))
+		self.query("TC1").addCallback(setError)
+
+	def __record(self, cmdStr, sent):
+		elapsed = time.time() - sent
+		stats = self.latency.setdefault(commandName(cmdStr), [0, 0., 0., 0.])
+		stats[0] += 1
+		stats[1] += elapsed
+		stats[2] = max(stats[2], elapsed)
+		stats[3] = elapsed
+
+	def __readUnsol(self):
+		try:
+			self.unsolReader.fill()
+		except socket.error:
+			with self.lock:
+				self.unsolCon = None
+			return
+		while True:
+			i, term = self.unsolReader.find(("\r\n",))
+			if i < 0:
+				return
+			self.unsolStream.put(self.unsolReader.take(i + 2)[:-2])
+
+	def __readUDP(self):
+		while True:
+			try:
+				dat, addr = self.drSock.recvfrom(1024)
+			except socket.error:
+				return
+			recvTime = time.time()
+			dr = None
+			if len(dat) >= 4 and len(dat) == (ord(dat[2]) | ord(dat[3]) << 8):
+				dr = drParse.parseDataRecord(dat)
+			if dr:
+				if "I" in dr:
+					self.drStats.update(dr.state("I")[0], recvTime)
+				self.recordStream.put((recvTime, dr))
+				continue
+
+			# a reply to a UDP command, ":" terminated like the TCP ones
+			self.udpText += dat
+			while ":" in self.udpText:
+				ret, self.udpText = self.udpText.split(":", 1)
+				with self.lock:
+					if not self.udpPending:
+						continue
+					future, sent, deadline = self.udpPending.popleft()
+				future.setResult(ret.strip())
+
+	def __expire(self):
+		# fail and drop the requests that are past their deadline
+		now = time.time()
+		with self.lock:
+			late = [entry for entry in self.pending if entry[2] <= now]
+			for entry in late:
+				self.pending.remove(entry)
+			lateUDP = [entry for entry in self.udpPending if entry[2] <= now]
+			for entry in lateUDP:
+				self.udpPending.remove(entry)
+		for future, sent, deadline in late + lateUDP:
+			future.setError(socket.timeout("No reply to %s" % future.cmdStr))
+		if late:		# the reply may still come, and would go to the next request
+			self.__reconnect("Reconnected after no reply to %s" % late[0][0].cmdStr)
+
+	def close(self):
+		if self.thread is None:
+			return
+		if self.running:
+			self.stopRecords()
+		with self.lock:
+			self.running = False
+		self.__wake()
+		self.thread.join()
+		self.thread = None
+		for sock in (self.con, self.unsolCon, self.drSock, self.wakeSock):
+			if sock:
+				try:
+					sock.close()
+				except socket.error:
+					pass
+		self.con = self.unsolCon = self.drSock = None
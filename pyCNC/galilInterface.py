@@ -2,6 +2,7 @@
 
 
 import time
+import Queue
 import threading
 import traceback
 
@@ -18,6 +19,7 @@ import sys
 
 import struct
 import drParse
+import drLog
 
 import os.path
 
@@ -28,6 +30,447 @@ logTimeStamps = True
 
 CONF_TIMEOUT = 0.5
 
+DR_INTERVAL = 103		# servo samples between data records ("DR n")
+DR_STATS_INTERVAL = 10		# seconds between writing the data record loss statistics to posvelDR.txt
+
+HEALTH_INTERVAL = 5		# seconds between checks that the command handles still answer
+
+DR_STALE = 0.5			# seconds without a data record before the position polling over TCP takes over again
+
+# axis status bits in the data record axis blocks
+STATUS_MOVING		= 1<<15		# move in progress
+STATUS_MOTOR_OFF	= 1<<0
+
+# Commands that only read state. They go to the query handle, everything else (motion, and
+# anything that changes state, which has to stay in order with the motion commands) to the
+# motion handle, so a slow status query never holds up a stop.
+QUERY_COMMANDS = ("TP", "TV", "TE", "TT", "TS", "TC", "TD", "TH", "TI", "SC", "RP", "MG", "QZ", "WH")
+
+
+def commandName(cmdStr):
+	# the command mnemonic of a command string ("TP", "PA", "XQ", ...), used to group latencies
+	return cmdStr.strip()[:2].upper()
+
+def splitCommands(commands):
+	# the individual commands in a list of (possibly ";" separated) command strings
+	return [cmd.strip() for cmdStr in commands for cmd in cmdStr.split(";") if cmd.strip()]
+
+def commandCount(cmdStr):
+	# number of commands (so acknowledgements from the galil) in a ";" separated command string
+	return len(splitCommands(cmdStr.split("\r")))
+
+
+def packLines(commands, maxLen = 80):
+	# Join commands with ";" into as few command lines as fit in maxLen characters each
+	lines = []
+	line = ""
+	for cmd in splitCommands(commands):
+		if line and len(line) + 1 + len(cmd) > maxLen:
+			lines.append(line)
+			line = ""
+		line = line + ";" + cmd if line else cmd
+	if line:
+		lines.append(line)
+	return lines
+
+
+class CommandBatch:
+	# Commands collected to be sent in one write by GalilInterface.sendBatch:
+	#
+	#	batch = gInt.batch()
+	#	batch.add("SPA=1000")
+	#	batch.add("PAA=5000")
+	#	batch.add("BG A")
+	#	batch.send()
+	#
+	# or as a with block, which sends on leaving. send() raises ValueError naming the
+	# commands the galil rejected, the per command results are kept in .results either way.
+
+	def __init__(self, galil):
+		self.galil = galil
+		self.commands = []
+		self.results = None
+
+	def add(self, cmdStr):
+		self.commands.extend(splitCommands([cmdStr]))
+		return self
+
+	def send(self, debug = True, timeout = CONF_TIMEOUT):
+		self.results = self.galil.sendBatch(self.commands, debug, timeout)
+		failed = ["%s (%s)" % (cmd, error) for cmd, (ret, error) in zip(self.commands, self.results) if error]
+		self.commands = []
+		if failed:
+			raise ValueError, "Galil command errors: " + ", ".join(failed)
+		return [ret for ret, error in self.results]
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, excValue, tb):
+		if excType is None:
+			self.send()
+
+
+class Request:
+	# A call queued for the command dispatcher thread, and its outcome
+	def __init__(self, func, args, kwargs):
+		self.func = func
+		self.args = args
+		self.kwargs = kwargs
+		self.done = threading.Event()
+		self.result = None
+		self.error = None		# sys.exc_info() if the call raised
+
+	def run(self):
+		try:
+			self.result = self.func(*self.args, **self.kwargs)
+		except:
+			self.error = sys.exc_info()
+		self.done.set()
+
+
+class ConnectionClosed(socket.error):
+	# The galil closed the connection (recv returned nothing). Not retried, unlike other socket errors
+	pass
+
+
+class SocketReader:
+	# Buffered reads of terminated responses from one socket.
+	#
+	# Reads as much as the socket has (recv_into a fixed bytearray) rather than one byte per
+	# recv, and keeps whatever comes after a terminator for the next call. The terminator
+	# search carries on from where the previous one stopped, so a response is only scanned
+	# once however many reads it arrives in.
+
+	def __init__(self, con, size = 4096):
+		self.con = con
+		self.chunk = bytearray(size)
+		self.view = memoryview(self.chunk)
+		self.pending = bytearray()
+		self.scanned = 0		# no terminator in pending[:scanned]
+
+	def fill(self):
+		# one recv, raises socket.timeout / socket.error like recv
+		n = self.con.recv_into(self.chunk)
+		if not n:
+			raise ConnectionClosed, "Connection closed"
+		self.pending += self.view[:n]
+		return n
+
+	def find(self, terminators):
+		# (index, terminator) of the first terminator in pending, or (-1, None)
+		found, which = -1, None
+		for term in terminators:
+			i = self.pending.find(term, max(0, self.scanned - len(term) + 1))
+			if i >= 0 and (found < 0 or i < found):
+				found, which = i, term
+		if found < 0:
+			self.scanned = len(self.pending)
+		return found, which
+
+	def readUntil(self, terminators, deadline = None):
+		# Everything up to and including the first of terminators, and which one it was.
+		# Timeouts and socket errors are raised with the partial response kept in pending.
+		# With a deadline (a time.time() value) socket.timeout is raised once it passes,
+		# however many reads it took, instead of the socket timeout applying to each read.
+		if deadline is not None:
+			timeout = self.con.gettimeout()
+		try:
+			while True:
+				i, term = self.find(terminators)
+				if i >= 0:
+					return self.take(i + len(term)), term
+				if deadline is not None:
+					remaining = deadline - time.time()
+					if remaining <= 0:
+						raise socket.timeout, "timed out"
+					self.con.settimeout(remaining)
+				self.fill()
+		finally:
+			if deadline is not None:
+				self.con.settimeout(timeout)
+
+	def take(self, n = None):
+		# remove and return the first n (default all) pending bytes
+		if n is None:
+			n = len(self.pending)
+		ret = str(self.pending[:n])
+		del self.pending[:n]
+		self.scanned = 0
+		return ret
+
+	def clear(self):
+		self.take()
+
+
+
+def readResponse(reader, deadline = None):
+	# One response from reader's socket, up to the ":" or "?" terminator. Returns (response, terminator),
+	# terminator is None on a timeout, with the partial response left in the reader.
+	while True:						# Galil return strings end with a colon (":"). We read untill we either see a colon (or a "?"), or time out
+		try:
+			return reader.readUntil((":", "?"), deadline)
+
+		except socket.timeout:					# Exit on timeout
+			print "Galil Timed Out"
+			traceback.print_exc(6)
+			return "", None
+
+		except ConnectionClosed:				# nothing more will come, let the caller reconnect
+			raise
+
+		except socket.error:					# I've Seen socket.error errors a few times. They seem to not break anything.
+									# Therefore, we just ignore them (until the deadline, the socket may have closed)
+			print "wut"
+			if deadline is not None and time.time() >= deadline:
+				return "", None
+			if deadline is None:
+				deadline = time.time() + CONF_TIMEOUT
+
+
+class CommandHandle:
+	#
+	# One TCP connection (a galil "handle") for commands, with its own dispatcher thread.
+	#
+	# Every command on the handle goes through that thread, fed by a queue, so commands from
+	# the GUI, the serial thread and the polling threads cannot interleave on the socket
+	# or pick up each other's replies. Commands on different handles do not wait for each other.
+	#
+	# The galil acknowledges every command in order (":", or "?" on an error), so the
+	# acknowledgements of commands sent with sendOnly are counted (unacked) and read before
+	# the reply to the next sendAndRecieve. No need to flush the socket, or to wait before
+	# reading.
+	#
+	# If the connection drops, the next command reconnects (once). Only handles made with
+	# resend = True (the query handle) send the command again on the new connection. On the
+	# motion handle the galil may already have run it (a PR and BG twice is a second move),
+	# so the socket.error is raised and the caller decides.
+	#
+
+	def __init__(self, ip, port, name, timeout = CONF_TIMEOUT, resend = False):
+		self.ip = ip
+		self.port = port
+		self.name = name
+		self.timeout = timeout
+		self.resend = resend
+
+		self.con = None
+		self.reader = None
+		self.unacked = 0		# commands sent that the galil has not acknowledged yet
+		self.latency = {}		# command -> [count, total, max, last] seconds from sending to the reply, see latencies()
+		self.reconnects = 0
+
+		self.requests = Queue.Queue()
+		self.dispatcher = None
+
+	def connect(self):
+		self.con = socket.create_connection((self.ip, self.port), self.timeout)
+		self.con.settimeout(self.timeout)
+		self.reader = SocketReader(self.con)
+		self.unacked = 0
+
+		if not self.dispatcher or not self.dispatcher.is_alive():
+			self.dispatcher = threading.Thread(target = self.__dispatchLoop, name = "galil%sCommandThread" % self.name.capitalize())
+			self.dispatcher.daemon = True
+			self.dispatcher.start()
+
+	def reconnect(self):
+		print "Reconnecting %s handle" % self.name
+		self.reconnects += 1
+		self.__closeSocket()
+		self.connect()
+
+	def __closeSocket(self):
+		if self.con is not None:
+			try:
+				self.con.shutdown(socket.SHUT_RDWR)
+				self.con.close()
+			except:
+				pass
+			self.con = None
+			self.unacked = 0		# nothing more comes on it
+
+	def close(self):
+		if self.dispatcher and self.dispatcher.is_alive():
+			self.requests.put(None)
+			self.dispatcher.join()
+		self.__closeSocket()
+
+	def __dispatchLoop(self):
+		while True:
+			request = self.requests.get()
+			if request is None:			# close()
+				return
+			request.run()
+
+	def call(self, func, *args, **kwargs):
+		# Run func in the dispatcher thread and return (or raise) what it does. Calls from
+		# the dispatcher itself (TC1 after an error), or once it has stopped, run directly.
+		if not self.dispatcher or not self.dispatcher.is_alive() or threading.current_thread() is self.dispatcher:
+			return func(*args, **kwargs)
+		request = Request(func, args, kwargs)
+		self.requests.put(request)
+		request.done.wait()
+		if request.error:
+			raise request.error[0], request.error[1], request.error[2]
+		return request.result
+
+	def healthy(self):
+		# does the handle answer (WH, "which handle") within the timeout
+		try:
+			retString, term = self.call(self.__exchange, "WH", False, self.timeout)
+		except socket.error:
+			return False
+		return term is not None
+
+	def flush(self):
+		# throw away whatever is buffered, and forget the acknowledgements still owed
+		self.reader.clear()
+		try:
+			self.con.settimeout(0.0)
+			self.con.recv(1024)
+		except:
+			pass
+		finally:
+			self.con.settimeout(self.timeout)
+		self.unacked = 0
+
+
+	def sendOnly(self, cmdStr, debug = True):				# Send a command string without listening for a response
+		self.call(self.__sendOnly, cmdStr, debug)
+
+	def __sendOnly(self, cmdStr, debug = True):
+		cmdStr = cmdStr + "\r"						# append the line terminator the galil wants
+
+		if debug: print "Sent Command - \"", cmdStr.rstrip().strip(), "\""
+
+		if self.con is None:
+			self.reconnect()
+		try:
+			self.con.sendall(cmdStr)
+		except socket.error:						# the connection dropped, reconnect for the next command
+			self.reconnect()
+			if not self.resend:
+				raise socket.error, "Connection to the galil dropped sending %s, not sent again" % cmdStr.strip()
+			self.con.sendall(cmdStr)
+		self.unacked += commandCount(cmdStr)
+
+	def __readResponse(self, deadline = None, errorCode = True):
+		# readResponse, keeping count of the acknowledgements.
+		# errorCode = False skips asking the galil (TC1) what went wrong on a "?".
+		try:
+			retString, term = readResponse(self.reader, deadline)
+		except ConnectionClosed:
+			self.__closeSocket()				# the next command reconnects
+			raise
+		if term is None:
+			return retString, term
+
+		if self.unacked > 0:
+			self.unacked -= 1
+
+		if term == "?" and errorCode:				# print error info if we recieve a error
+			print "Syntax Error - ",
+			print "Returned Value:", retString
+			print "Error Code:"
+			print self.sendAndRecieve("TC1")		# "TC1" - This queries the galil for what the previous error was caused by
+		return retString, term
+
+	def __drainAcks(self, deadline):
+		# Read the acknowledgements of the commands sent with sendOnly, so the next response
+		# read is the reply to the next command. If they do not all turn up, fall back to
+		# throwing away whatever is buffered.
+		while self.unacked > 0:
+			retString, term = self.__readResponse(deadline)
+			if term is None:
+				self.flush()
+				return
+
+	def sendBatch(self, commands, debug = True, timeout = CONF_TIMEOUT):
+		return self.call(self.__sendBatch, commands, debug, timeout)
+
+	def __sendBatch(self, commands, debug = True, timeout = CONF_TIMEOUT):
+		#
+		# Send a list of commands in one go, ";" separated on as few lines as fit (see packLines),
+		# all in a single write, then read back the acknowledgement of each. One round trip
+		# instead of one per command.
+		#
+		# Returns a list of (response, error) per command (splitCommands(commands)), in order. response is stripped
+		# like sendAndRecieve's, error is None if the galil accepted the command, its
+		# error message (TC1) if it answered "?", or "No response" if nothing came back
+		# before the timeout.
+		#
+		deadline = time.time() + timeout
+		self.__drainAcks(deadline)
+
+		commands = splitCommands(commands)
+		if not commands:
+			return []
+		self.__sendOnly("\r".join(packLines(commands)), debug)
+
+		results = []
+		rejected = []
+		for cmd in commands:
+			retString, term = self.__readResponse(deadline, errorCode = False)
+			if term is None:
+				results.append(("", "No response"))
+				continue
+			if term == "?":
+				rejected.append(len(results))
+			results.append((retString.rstrip("\r\n:?").strip().strip(":"), None))
+
+		if rejected:
+			# TC1 only knows the most recent error, the others get its number left off
+			message = self.sendAndRecieve("TC1", debug = False)
+			for i in rejected:
+				results[i] = (results[i][0], message if i == rejected[-1] else "Rejected")
+			if debug:
+				for i in rejected:
+					print "Command Error - \"", commands[i], "\"", results[i][1]
+
+		return results
+
+	def sendAndRecieve(self, cmdStr, debug = True, timeout = CONF_TIMEOUT):
+		retString, term = self.call(self.__exchange, cmdStr, debug, timeout)
+		return retString
+
+	def __exchange(self, cmdStr, debug = True, timeout = CONF_TIMEOUT):
+		#
+		#	This is probably a little brittle for long term reliance
+		#
+		# Anyways, you pass the command you want to send the galil, and a
+		# line termniator is autmatically appended, and the return value is read
+		# back, and returned, with the terminator (None on a timeout).
+		#
+		# The return value has the line terminator and some of the window decoration (":")
+		# stripped from it to make it easier to parse
+		#
+		# We read as soon as the reply arrives, until timeout seconds have passed.
+		#
+		deadline = time.time() + timeout
+		self.__drainAcks(deadline)
+
+		start = time.time()
+		self.__sendOnly(cmdStr, debug)			# send the command string
+		retString, term = self.__readResponse(deadline)	# check for the response.
+		if term is None:
+			return "", None				# the acknowledgement is still owed (unacked), it gets drained before the next command
+
+		elapsed = time.time() - start
+		stats = self.latency.setdefault(commandName(cmdStr), [0, 0., 0., 0.])
+		stats[0] += 1
+		stats[1] += elapsed
+		stats[2] = max(stats[2], elapsed)
+		stats[3] = elapsed
+
+		retString = retString.rstrip("\r\n:").strip().strip(":")	# and strip off the garbage the galil sends to make interacting with it over telnet easier.
+
+		return retString, term
+
+	def latencies(self):
+		# {command: (count, mean, max, last)} of the sendAndRecieve round trip times, in seconds
+		return dict((cmd, (count, total/count, worst, last)) for cmd, (count, total, worst, last) in self.latency.items())
+
 
 class GalilInterface:
 
@@ -37,24 +480,49 @@ class GalilInterface:
 	pos		= [0,0,0,0,0,0,0,0,0]
 	vel		= [0,0,0,0,0,0,0,0,0]
 	inMot		= [0,0,0,0,0,0,0,0,0]
+	motOn		= [0,0,0,0,0,0,0,0,0]
+
+	stateTime	= 0		# time.time() of the data record pos, vel, inMot and motOn were last set from
 
 	oldTime = 0
 
 	udpInBuffer = ""
 
+	drStats = None		# drParse.SampleStats of the UDP data records, once they are started
+	drStateNames = "I" + "ABCDEFGH"[:numAxis]	# the data record blocks the live state is read from
+
 	threads = []
 
+	# The galil has eight ethernet handles. We use:
+	#	motion	- commands that move or change state (CommandHandle, port)
+	#	query	- status queries (CommandHandle, port+1)
+	#	unsolCon	- unsolicited messages (port+1)
+	#	and a UDP handle for the data records
+	motion = None
+	query = None
+
+	readers = {}		# id(socket) -> SocketReader. By id, the fake sockets are not hashable
+
 	def __axisIntToLetter(self, axis):
 		return chr(65+axis)
 
 	def __axisLetterToInt(self, axis):
 		return ord(axis[-1])-65
 
+	def reader(self, socketConnection):
+		# the SocketReader buffering socketConnection
+		try:
+			return self.readers[id(socketConnection)]
+		except KeyError:
+			ret = self.readers[id(socketConnection)] = SocketReader(socketConnection)
+			return ret
+
 	def __init__(self, ip, port = 23, fakeGalil = False, poll = False, resetGalil = False, download = True, unsol = True):
 
 
 		self.port = port
 		self.ip = ip
+		self.readers = {}
 
 		print "Starting Interface"
 		if not fakeGalil:
@@ -67,9 +535,8 @@ class GalilInterface:
 
 
 
-		self.con = socket.create_connection((self.ip, self.port ), CONF_TIMEOUT)
-		self.con.settimeout(CONF_TIMEOUT)
-
+		self.motion = CommandHandle(self.ip, self.port, "motion")
+		self.motion.connect()
 
 		if resetGalil:
 			print "Resetting Galil"
@@ -77,7 +544,15 @@ class GalilInterface:
 			
 
 
-		self.sendOnly("IHT=-3;")	# Close ALL THE (other) SOCKETS
+		self.motion.sendAndRecieve("IHT=-3;")	# Close ALL THE (other) SOCKETS. Before we open ours, and waiting for the
+							# acknowledgement, so it can't catch them
+
+		self.query = CommandHandle(self.ip, self.port+1, "query", resend = True)	# queries are safe to send twice
+		self.query.connect()
+
+		self.healthTh = threading.Thread(target = self.checkHandles, name = "galilHealthThread")
+		self.healthTh.start()
+		self.threads.append(self.healthTh)
 
 		if poll:
 			print "Beginning Solicited TCP Polling"
@@ -87,7 +562,26 @@ class GalilInterface:
 			print "Opening Unsolicited messages socket."
 			self.__initUnsolicitedMessageSocket()
 
+	def checkHandles(self):
+		# every HEALTH_INTERVAL seconds, reconnect command handles that stopped answering
+		lastCheck = time.time()
+		while self.running:
+			time.sleep(0.1)
+			if time.time() - lastCheck < HEALTH_INTERVAL:
+				continue
+			lastCheck = time.time()
+			for handle in (self.motion, self.query):
+				if not handle.healthy():
+					try:
+						handle.call(handle.reconnect)
+					except socket.error:
+						print "Could not reconnect the %s handle" % handle.name
+
 	def __initUnsolicitedMessageSocket(self):
+		self.__openUnsolicitedMessageSocket()
+		self.startPollingUnsol()
+
+	def __openUnsolicitedMessageSocket(self):
 		# The reccomended way for handling both solicited and unsolicited messages from the galil is to use two sockets. One socket is for normal 
 		# comms, and the other is configured for handling the unsolicited messages (e.g. interrupt messages, etc...)
 
@@ -101,8 +595,6 @@ class GalilInterface:
 		# messages to be set. I don't know what the default setting is, though. 
 		self.unsolCon.sendall("CW 2;\r\n")
 		self.recieveOnly(self.unsolCon)
-		
-		self.startPollingUnsol()
 
 
 	def startPollingUnsol(self):
@@ -114,37 +606,40 @@ class GalilInterface:
 
 	def pollUnsol(self):
 		
-		retString = ""
 		while self.running:
 
 			
 			try:
-				retString += self.unsolCon.recv(1)
+				message, term = self.reader(self.unsolCon).readUntil(("\r\n",), time.time() + CONF_TIMEOUT)	# a deadline, so self.running is checked whatever the socket does
+				message = message[:-2]
 
 			except socket.timeout:					# Exit on timeout
-				pass
+				continue
 
-			except socket.error:					# I've Seen socket.error errors a few times. They seem to not break anything.
-										# Therefore, we just ignore them
+			except socket.error:					# The connection dropped (or one of the socket.error errors that don't break anything)
 				print "wut"
-				pass
-
-			if retString.find("\r\n")+1:				# 
-				message, retString = retString.split("\r\n", 1)
-				print "Received message - ", message
-				
-				if logTimeStamps:
-					if message.find("Input Timestamp") + 1:
-						# for some bizarre reason, the galil returns timestamps with four trailing zeros (e.g. xxx.0000)
-						# The timestamps are ALWAYS just an integer
-						# Anyways, the python int() function can't handle strings with a decimal, so we split off the 
-						# empty fractional digits
-						time = int(message.split()[-1].split(".")[0])
-						delta = time - self.oldTime
-						self.oldTime = time
-						print "Timestamp", int(time), "Delta", delta
-						with open("tsLog.txt", "a") as fp:
-							fp.write("Timestamp, %s, %s \n" % (time, delta))
+				try:
+					self.readers.pop(id(self.unsolCon), None)		# the new socket gets a new reader
+					self.unsolCon.close()
+					self.__openUnsolicitedMessageSocket()
+				except socket.error:
+					time.sleep(1)
+				continue
+
+			print "Received message - ", message
+			
+			if logTimeStamps:
+				if message.find("Input Timestamp") + 1:
+					# for some bizarre reason, the galil returns timestamps with four trailing zeros (e.g. xxx.0000)
+					# The timestamps are ALWAYS just an integer
+					# Anyways, the python int() function can't handle strings with a decimal, so we split off the 
+					# empty fractional digits
+					ts = int(message.split()[-1].split(".")[0])
+					delta = ts - self.oldTime
+					self.oldTime = ts
+					print "Timestamp", ts, "Delta", delta
+					with open("tsLog.txt", "a") as fp:
+						fp.write("Timestamp, %s, %s \n" % (ts, delta))
 
 
 	def flushBufUDP(self, socketConnection, galilAddrTup):
@@ -180,7 +675,7 @@ class GalilInterface:
 
 	def sendAndRecieveUDP(self, cmdStr, socketConnection, addrTuple):
 		#First, we need to clear the input buffer, because we want to get rid of any previous strings
-		self.flushSocketRecvBuf(self.con)
+		self.flushSocketRecvBuf(socketConnection)
 
 
 		cmdStr = cmdStr + "\r\n"
@@ -194,6 +689,8 @@ class GalilInterface:
 	def initUDPMessageSocket(self):
 
 		print "Opening UDP Socket"
+		# Once the data records are coming in, they keep pos, vel, inMot and motOn up to date
+		# (see updateFromRecord), and posVelPol only polls when they stop for DR_STALE seconds.
 		
 		# We need to know the local address to bind to to receive UDP messages from the galil
 		# There is not particularly elegant way to get this. As such, we open a TCP socket connection
@@ -241,7 +738,8 @@ class GalilInterface:
 			print "Ret: \"", tmp, "\""
 			tmp = self.receiveUDP(drSock)
 
-		drSock.sendto("DR 103,%s\r\n" % self.udpHandleNumber, GALIL_UDP_ADDR_TUPLE)
+		self.drStats = drParse.SampleStats(DR_INTERVAL)
+		drSock.sendto("DR %d,%s\r\n" % (DR_INTERVAL, self.udpHandleNumber), GALIL_UDP_ADDR_TUPLE)
 
 		#drSock.settimeout(1)
 		#time.sleep(1)
@@ -265,26 +763,27 @@ class GalilInterface:
 
 
 	def pollUDP(self, udpSock, galilAddrTup):
-		fp = open("posvelDR.txt", "a")
+		fp = open("posvelDR.txt", "a")			# errors and loss statistics only. The records themselves go to the binary log
+		drLogger = drLog.DRLogWriter("posvelDR.drlog")	# the time stamps (and their error against our clock) can be pulled
+								# out of it afterwards, see plot.py
+		lastStats = time.time()
 		while self.running:
 
 			
 			try:
 				dat, ip = udpSock.recvfrom(1024)
+				recvTime = time.time()
 				#print "received", len(dat), ip, 
+				drLogger.write(dat, recvTime)
 				dr = drParse.parseDataRecord(dat)
 
-				if dr:
-					ts = ((dr["I"]["GI8"] & 0x1F) * 2**24) + (dr["I"]["GI9"] * 2**16) + (dr["I"]["GI5"] * 2**8) + (dr["I"]["GI4"])
-					#print dr["I"]["GI4"], dr["I"]["GI5"], dr["I"]["GI9"], dr["I"]["GI8"] & 0x1F
-					curTOW = drParse.getMsTOWwMasking()
-					towErr = curTOW - ts
-					logStr = "DR Received, %s, %s, %s, %s\n" % (int(time.time()*1000), curTOW, ts, towErr)
-					#logStr = "DR Received, %s, %s, %s, %s\n" % (dr["I"]["GI4"], dr["I"]["GI5"], dr["I"]["GI9"], dr["I"]["GI8"])
-					print logStr,
-					fp.write(logStr)
+				if not dr:
+					fp.write("Bad DR Received, %s\n" % (recvTime))
 				else:
-					fp.write("Bad DR Received, %s\n" % (time.time()))
+					state = dr.state(self.drStateNames)	# just the fields used here, no blocks decoded
+					sn = dr.stateIndex("I", self.drStateNames)
+					if sn is None or self.drStats.update(state[sn], recvTime):	# not for duplicates, or records that arrived late
+						self.updateFromRecord(dr, recvTime, state)
 			except socket.timeout:					# Exit on timeout
 				pass
 
@@ -293,6 +792,10 @@ class GalilInterface:
 				print "wut"
 				fp.write("Socket Error, %s, %s\n" % (time.time(), time.strftime("Datalog - %Y/%m/%d, %a, %H:%M:%S", time.localtime())))
 				pass
+
+			if time.time() - lastStats >= DR_STATS_INTERVAL:	# the loss / ordering counters, every so often
+				lastStats = time.time()
+				fp.write("Stats, %s, %s\n" % (lastStats, self.drStats.snapshot()))
 		# Turn off the data-record outputs
 		self.sendAndRecieveUDP("DR 0,0;\r\n", udpSock, galilAddrTup)	
 
@@ -318,8 +821,29 @@ class GalilInterface:
 				print "wut"
 				pass
 
+		fp.write("Stats, %s, %s\n" % (time.time(), self.drStats.snapshot()))
+		print self.drStats
+		drLogger.close()
 		fp.close()
 
+	def updateFromRecord(self, dr, recvTime, state = None):
+		# Set the live axis state (pos, vel, inMot, motOn) from a data record (and its dr.state(self.drStateNames), if already read).
+		# New lists are built and then swapped in, so readers never see a half updated one.
+		if state is None:
+			state = dr.state(self.drStateNames)
+		pos, vel, inMot, motOn = list(self.pos), list(self.vel), list(self.inMot), list(self.motOn)
+		for x in range(self.numAxis):
+			i = dr.stateIndex(self.__axisIntToLetter(x), self.drStateNames)
+			if i is None:
+				continue
+			status = state[i]
+			pos[x] = state[i+1]
+			vel[x] = state[i+2]
+			inMot[x] = bool(status & STATUS_MOVING)
+			motOn[x] = not status & STATUS_MOTOR_OFF
+		self.pos, self.vel, self.inMot, self.motOn = pos, vel, inMot, motOn
+		self.stateTime = recvTime
+
 	def __downloadFunctions(self):
 
 		#
@@ -330,10 +854,11 @@ class GalilInterface:
 		# just something you have to keep in mind.
 		#
 
+		con = self.motion.con
 		#First, we need to clear the input buffer, because we want to get rid of any previous strings
-		self.con.settimeout(0.0)
+		con.settimeout(0.0)
 		try:
-			self.con.recv(256)
+			con.recv(256)
 		except:
 			pass
 
@@ -342,7 +867,7 @@ class GalilInterface:
 		routines = codeFile.read()
 		codeFile.close()
 
-		self.con.sendall("DL\r")					# Enter program download mode
+		con.sendall("DL\r")					# Enter program download mode
 
 		lineNum = 1							# for printing a nice representation of the code
 
@@ -370,9 +895,9 @@ class GalilInterface:
 			print str(lineNum).zfill(4), cleanedLine.rstrip()	# Print linenum and line (and strip the extra \r / \n) (for debugging)
 			lineNum += 1
 
-			self.con.sendall(cleanedLine)				# finally, send the line
+			con.sendall(cleanedLine)				# finally, send the line
 			try:
-				if self.con.recv(256):				# and check for a response
+				if con.recv(256):				# and check for a response
 										# (there shouldn't be. You only get a response of there is an error)
 					raise ValueError, "Error downloading galil code"
 			except:
@@ -381,27 +906,23 @@ class GalilInterface:
 			time.sleep(0.05)					# a short pause so we don't overflow the galil's TCP input buffer
 												# (Yes, it was happening)
 
-		self.con.sendall("\\\r")					# leave program download mode
+		con.sendall("\\\r")					# leave program download mode
 
 		time.sleep(0.1)							# Needed to work around some bugs in the crApple python TCP stack
 
 		print "Sent"
 		try:
-			print "Recieved - ", self.con.recv(64).rstrip().lstrip().rstrip(":").lstrip(":")			# Check status return code from the download operaton
+			print "Recieved - ", con.recv(64).rstrip().lstrip().rstrip(":").lstrip(":")			# Check status return code from the download operaton
 										# It should be two colons ("::"). Should probably check that
 		except:
 			print "Galil Timed Out"
 			traceback.print_exc(6)
 
 
-		self.con.settimeout(CONF_TIMEOUT)
+		con.settimeout(CONF_TIMEOUT)
 
 
 	def __startPolling(self):
-		self.polCon = socket.create_connection((self.ip, self.port + 1), CONF_TIMEOUT)
-		self.polCon.settimeout(CONF_TIMEOUT)
-		#self.con.setblocking(0)
-
 		self.pollPosTh = threading.Thread(target = self.posVelPol, name = "galilPollThread")
 		self.pollPosTh.start()
 		self.threads.append(self.pollPosTh)
@@ -419,6 +940,7 @@ class GalilInterface:
 	def flushSocketRecvBuf(self, socketCon):
 		#python socket.socket doesn't have a flush() function! WTF?
 
+		self.reader(socketCon).clear()
 		try:
 			socketCon.settimeout(0.0)
 			socketCon.recv(1024)
@@ -431,7 +953,10 @@ class GalilInterface:
 	def posVelPol(self):
 		fp = open("posvelpol.txt", "a")
 		while self.running:
-			self.flushSocketRecvBuf(self.polCon)
+
+			if time.time() - self.stateTime < DR_STALE:	# the data records are keeping the state up to date, no need to ask
+				time.sleep(0.1)
+				continue
 				
 			try:
 				# Horrible one-liners of DOOOOOOOMMMMM
@@ -440,13 +965,11 @@ class GalilInterface:
 				# typeconverts to int, and stuffs them into a list
 				#
 
-				self.polCon.sendall("TP\r\n")
-				temp =  [int(float(i)) for i in self.recieveOnly(self.polCon).rstrip("\r\n:").strip().strip(":").replace(", ", " ").split()]
+				temp =  [int(float(i)) for i in self.query.sendAndRecieve("TP", debug = False).replace(", ", " ").split()]
 				self.pos = temp
 
 				# and for the "TV" command
-				self.polCon.sendall("TV\r\n")
-				temp = [int(float(i)) for i in self.recieveOnly(self.polCon).rstrip("\r\n:").strip().strip(":").replace(", ", " ").split()]
+				temp = [int(float(i)) for i in self.query.sendAndRecieve("TV", debug = False).replace(", ", " ").split()]
 				self.vel = temp
 
 				#Now, we check axis state (moving or not moving)
@@ -456,15 +979,15 @@ class GalilInterface:
 				for x in range(self.numAxis):
 					axLetter = self.__axisIntToLetter(x)
 					motionStStr += ", _BG%s, _MO%s" % (axLetter, axLetter)
-				motionStStr += "\r\n"
 
 				# then query the galil
-				self.polCon.sendall(motionStStr)
-				recStr = self.recieveOnly(self.polCon)
+				recStr = self.query.sendAndRecieve(motionStStr, debug = False)
 
 				#finally, another horrible one-liner to parse the return string
 
-				self.inMot = [bool(int(i.split(".")[0])) for i in recStr.rstrip("\r\n:").strip().strip(":").replace(", ", " ").split()]
+				temp = [bool(int(i.split(".")[0])) for i in recStr.replace(", ", " ").split()]
+				self.inMot = temp[0::2]				# _BG, then _MO for each axis
+				self.motOn = [not i for i in temp[1::2]]
 
 				#print motionStStr, recStr
 
@@ -488,13 +1011,24 @@ class GalilInterface:
 			raise ValueError, "Invalid Axis"
 
 
-	def sendOnly(self, cmdStr, debug = True):				# Send a command string without listening for a response
-		cmdStr = cmdStr + "\r"						# append the line terminator the galil wants
+	def handleFor(self, commands):
+		# the handle for a command string (or list of them), see QUERY_COMMANDS
+		for cmd in splitCommands(commands if isinstance(commands, list) else [commands]):
+			if commandName(cmd) not in QUERY_COMMANDS:
+				return self.motion
+		return self.query or self.motion
 
-		if debug: print "Sent Command - \"", cmdStr.rstrip().strip(), "\""
+	def sendOnly(self, cmdStr, debug = True):				# Send a command string without listening for a response
+		self.handleFor(cmdStr).sendOnly(cmdStr, debug)
 
-		self.con.sendall(cmdStr)
+	def sendAndRecieve(self, cmdStr, debug = True, timeout = CONF_TIMEOUT):
+		# Send a command and return the reply, stripped of the terminator and window decoration.
+		# Returns as soon as the reply arrives, "" if it does not within timeout seconds.
+		return self.handleFor(cmdStr).sendAndRecieve(cmdStr, debug, timeout)
 
+	def sendBatch(self, commands, debug = True, timeout = CONF_TIMEOUT):
+		# see CommandHandle.sendBatch
+		return self.handleFor(commands).sendBatch(commands, debug, timeout)
 
 	def recieveOnly(self, socketConnection, mask=False):				# Recieve from the galil until the galil sends a line terminator
 										# The terminates lines with either a  ":" or a "?"
@@ -504,54 +1038,28 @@ class GalilInterface:
 
 
 
-		retString = ""
-		while not retString.find(":")+1:				# Galil return strings end with a colon (":"). We loop on the socket untill we either see a colon, or time out
-			try:
-				retString += socketConnection.recv(1)
-
-			except socket.timeout:					# Exit on timeout
-				print "Galil Timed Out"
-				traceback.print_exc(6)
-				break
-
-			except socket.error:					# I've Seen socket.error errors a few times. They seem to not break anything.
-										# Therefore, we just ignore them
-				print "wut"
-				pass
-
-			if retString.find("?")+1:				# print error info if we recieve a error
-				print "Syntax Error - ",
-				print "Returned Value:", retString
-				print "Error Code:"
-				print self.sendAndRecieve("TC1")		# "TC1" - This queries the galil for what the previous error was caused by
-				break
+		reader = self.reader(socketConnection)
+		retString, term = readResponse(reader)
+		if term is None:						# timed out, hand back whatever did arrive, like before
+			retString = reader.take()
+		elif term == "?":						# print error info if we recieve a error
+			print "Syntax Error - ",
+			print "Returned Value:", retString
+			print "Error Code:"
+			print self.sendAndRecieve("TC1")		# "TC1" - This queries the galil for what the previous error was caused by
 		return retString
 
-	def sendAndRecieve(self, cmdStr, debug = True):
-		#
-		#	This is probably a little brittle for long term reliance
-		#
-		# Anyways, you pass the command you want to send the galil, and a
-		# line termniator is autmatically appended, and the return value is read
-		# back, and returned.
-		#
-		# The return value has the line terminator and some of the window decoration (":")
-		# stripped from it to make it easier to parse
-		#
-
-		#First, we need to clear the input buffer, because we want to get rid of any previous strings
-		self.flushSocketRecvBuf(self.con)
-
-
-		self.sendOnly(cmdStr, debug)			# send the command string
-		time.sleep(0.050)				# give some time for the galil to respond
-		retString = ""
-
-
-		retString = self.recieveOnly(self.con)				# check for the response.
-		retString = retString.rstrip("\r\n:").strip().strip(":")	# and strip off the garbage the galil sends to make interacting with it over telnet easier.
+	def batch(self):
+		# a CommandBatch to collect commands in, sent together by its send()
+		return CommandBatch(self)
 
-		return retString
+	def latencies(self):
+		# {handle name: {command: (count, mean, max, last)}} of the sendAndRecieve round trip times, in seconds
+		ret = dict()
+		for handle in (self.motion, self.query):
+			if handle:
+				ret[handle.name] = handle.latencies()
+		return ret
 
 	def getPosition(self):
 
@@ -711,12 +1219,16 @@ class GalilInterface:
 	def resetGalil(self, download = True):	
 				#We re-download the galilcode on reset, since resetting clears the function memory
 				# if you don't want to re-download the functions, pass download = false
+		self.motion.call(self.__resetGalil, download)
+
+	def __resetGalil(self, download = True):
 
 		command = "RS"
 
-		self.sendOnly( command )
+		self.motion.sendOnly( command )
 
 		time.sleep(0.5)
+		self.motion.flush()		# the reset drops whatever acknowledgements were still owed
 		if download:
 			self.__downloadFunctions()
 
@@ -732,7 +1244,7 @@ class GalilInterface:
 					print "Stopping thread:", thread
 					thread.join()
 
-		if self.con:
+		if self.motion and self.motion.con is not None:
 			try:							# Since this is called both manually and by the destructor, we have to simply catch and ignore errors here.
 										# otherwise, there are errors arising from the fact that it winds up trying to close a closed connection.
 
@@ -744,12 +1256,13 @@ class GalilInterface:
 
 
 				self.sendOnly("IHT=-3;")	# Close ALL THE (other) SOCKETS
-				self.con.shutdown(socket.SHUT_RDWR)
-				self.con.close()
-				self.con = None
 			except:
 				pass
 
+		for handle in (self.query, self.motion):	# after the other threads, they may still be sending commands
+			if handle:
+				handle.close()
+
 
 	def __del__(self):
 		self.close()
@@ -160,28 +160,57 @@ class Controller:
 
         if not simulate:
 
+            commands = []
+
             # set speed and acceleration of axes
             if speed_az:
-                self.galil.sendOnly("SP" + self.galil.axis_az + "=" + str(speed_az))
-                self.galil.sendOnly("AC" + self.galil.axis_az + "=" + str(accel_az))
-                self.galil.sendOnly("DC" + self.galil.axis_az + "=" + str(accel_az))
+                commands.append("SP" + self.galil.axis_az + "=" + str(speed_az))
+                commands.append("AC" + self.galil.axis_az + "=" + str(accel_az))
+                commands.append("DC" + self.galil.axis_az + "=" + str(accel_az))
             if speed_el:
-                self.galil.sendOnly("SP" + self.galil.axis_el + "=" + str(speed_el))
-                self.galil.sendOnly("AC" + self.galil.axis_el + "=" + str(accel_el))
-                self.galil.sendOnly("DC" + self.galil.axis_el + "=" + str(accel_el))
+                commands.append("SP" + self.galil.axis_el + "=" + str(speed_el))
+                commands.append("AC" + self.galil.axis_el + "=" + str(accel_el))
+                commands.append("DC" + self.galil.axis_el + "=" + str(accel_el))
 
             # move to position
             if speed_az:
-                self.galil.sendOnly("PA" + self.galil.axis_az + "=" +
+                commands.append("PA" + self.galil.axis_az + "=" +
                     str(self.converter.az_to_encoder(begin[0] + d_az)))
             if speed_el:
-                self.galil.sendOnly("PA" + self.galil.axis_el + "=" +
+                commands.append("PA" + self.galil.axis_el + "=" +
                     str(self.converter.el_to_encoder(begin[1] + d_el)))
+
+            if commands:
+                self.send_setup(commands)
             self.logger.info(self.galil.sendAndReceive("BG"))
 
         return tm_tot
 
 
+    # send_setup: send motion setup commands, checking each one was accepted
+    #   commands -> list of commands
+    #
+    # With a galil interface that has sendBatch (galilInterface from pyCNC), the
+    # commands go out in one write, packed by its packLines, and the ":" or "?"
+    # acknowledgement of each is read back. A rejected command raises ValueError,
+    # so a slew never begins with half of its setup applied.
+    #
+    # Older PyGalil interfaces only have sendOnly, which reads no acknowledgements,
+    # so there the commands are sent one by one as before and errors are NOT detected.
+    def send_setup (self, commands):
+        if not hasattr(self.galil, "sendBatch"):
+            for command in commands:
+                self.galil.sendOnly(command)
+            return
+
+        results = self.galil.sendBatch(commands)
+        errors = [command + " (" + error + ")"
+            for command, (response, error) in zip(commands, results) if error]
+        if errors:
+            self.logger.error("Galil rejected " + ", ".join(errors))
+            raise ValueError("Galil rejected " + ", ".join(errors))
+
+
     # track: follow an equatorial position indefinitely
     #   equ_pos -> [ra, de]: position to track
     # -> (returns once tracking ends)